@@ -5,8 +5,14 @@
 
 from filoblu_service_np import FiloBluService
 from database import FiloBluDB
-from misc import add_method, repeat_interval, read_dictionary, preprocess, vectorize_sequence
+from async_runtime import AsyncRuntime
+from connection_pool import ConnectionPool
+from bio_cache import BiologicalCache
+from message_batch import MessageBatch, MessageBatchAssembler
+from scheduler import Scheduler, Job, scheduled, FIXED_RATE, FIXED_DELAY
+from misc import add_method, repeat_interval, Vocabulary, read_words, read_dictionary, preprocess, vectorize_sequence, sparse_sequence, preprocess_batch, sparse_batch, Prediction, PredictionCache, batched, predict_stream
 from network_model_np import NetworkModel
+from backends import get_backend, load_network_model
 from __version__ import __version__
 
 __author__  = ['Nico Curti', 'Andrea Ciardiello', 'Stefano Giagu']
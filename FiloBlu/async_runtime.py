@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from database import (DT_READ_DB, DT_LOAD_NEW_WEIGHTS, DT_CLEAR_LOG, DT_HISTORY_SCORE,
+                      DT_PROCESS_MAX_WAIT, DT_STOP)
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+class AsyncRuntime(object):
+  """
+  asyncio runtime of the FiloBluDB service loop.
+  All the stages run as tasks of a single event loop:
+
+    - reader : every DT_READ_DB seconds it reads the new pages of messages (FiloBluDB.read_pages)
+    - processor : it merges the queued batches and it evaluates the network (FiloBluDB.score_batches)
+    - writer : it writes the scores of all the queued batches (FiloBluDB.write_batches)
+    - maintenance : update of the network weights, clear of the log and dump of the score history
+
+  The stages are connected by bounded asyncio.Queue, so a slow stage blocks the previous one (backpressure).
+  The db I/O runs in a thread executor with one worker for each connection of the pool and the network
+  is evaluated in a dedicated single-thread executor, so the read of the next page overlaps with the
+  evaluation of the current one.
+  The network is reloaded in the inference executor, i.e. between two evaluations, so the other stages
+  never stop during the update of the weights.
+
+  The stop function can be called by any thread: the reader and the maintenance tasks are cancelled,
+  the messages already read are processed and written (up to DT_STOP seconds) and then the
+  executors are closed.
+
+  --------
+
+  Example
+    runtime = AsyncRuntime(db, network, dictionary, weights_file, update_dir, NetworkModel)
+    runtime.run_forever() # until runtime.stop()
+  """
+
+  def __init__(self, db, network, dictionary, weights_file, update_directory, load_network):
+    """
+    AsyncRuntime constructor.
+
+    --------
+
+    Variables
+      - db : FiloBluDB - the database object
+      - network : object - the neural network object (as tensorflow model or the numpy one)
+      - dictionary : dict - a dictionary in which keys are words and value are integer (freq order)
+      - weights_file : string - the filename of the current weight file loaded by the network
+      - update_directory : string - the directory in which the update files are located
+      - load_network : callable - function which loads the network from the weights file (ex. NetworkModel)
+    """
+    self._db = db
+    self._network = network
+    self._dictionary = dictionary
+    self._weights_file = weights_file
+    self._update_directory = update_directory
+    self._load_network = load_network
+
+    self._db_executor = ThreadPoolExecutor(max_workers=db.pool_stats['size'])
+    self._inference_executor = ThreadPoolExecutor(max_workers=1)
+
+    self._loop = None
+    self._stop = None
+    # set by stop: it is checked by run, so a stop before the start of the event loop is not lost
+    self._stop_requested = threading.Event()
+
+  async def _run_in(self, executor, function, *args):
+    return await self._loop.run_in_executor(executor, function, *args)
+
+  async def _wait_stop(self, timeout):
+    # True if the runtime is stopped within the timeout
+    try:
+      await asyncio.wait_for(self._stop.wait(), timeout=max(timeout, 0))
+    except asyncio.TimeoutError:
+      pass
+
+    return self._stop.is_set()
+
+  async def _every(self, interval, step, delay=0):
+    # fixed-rate repetition of the step (the first one after delay seconds) until the stop of the runtime
+
+    if await self._wait_stop(delay):
+      return
+
+    while not self._stop.is_set():
+      start = self._loop.time()
+
+      try:
+        await step()
+
+      except asyncio.CancelledError:
+        raise
+
+      except Exception as e:
+        self._db.log_error(e)
+
+      await self._wait_stop(interval - (self._loop.time() - start))
+
+  async def _read(self):
+
+    self._db.get_logger.info('Calling Callback message')
+
+    pages = self._db.read_pages()
+
+    while True:
+      batch = await self._run_in(self._db_executor, next, pages, None)
+
+      if batch is None:
+        break
+
+      await self._messages.put(batch) # text + biological values
+
+  async def _process(self):
+
+    target_size = self._db.config.get('process_batch_size', self._db.PROCESS_BATCH_SIZE)
+
+    while True:
+
+      batches = [await self._messages.get()]
+      size = len(batches[0])
+      deadline = self._loop.time() + DT_PROCESS_MAX_WAIT
+
+      while size < target_size:
+
+        try:
+          batch = await asyncio.wait_for(self._messages.get(), timeout=max(deadline - self._loop.time(), 0))
+        except asyncio.TimeoutError:
+          break
+
+        batches.append(batch)
+        size += len(batch)
+
+      try:
+        self._db.get_logger.info('Calling Callback process message')
+
+        scored = await self._run_in(self._inference_executor, self._db.score_batches,
+                                    batches, self._network, self._dictionary)
+
+        for batch in scored:
+          await self._scores.put(batch)
+
+      except asyncio.CancelledError:
+        raise
+
+      except Exception as e:
+        self._db.log_error(e)
+
+      finally:
+        for _ in batches:
+          self._messages.task_done()
+
+  async def _write(self):
+
+    while True:
+
+      batches = [await self._scores.get()]
+
+      while not self._scores.empty():
+        batches.append(self._scores.get_nowait())
+
+      try:
+        self._db.get_logger.info('Calling Callback write message')
+
+        await self._run_in(self._db_executor, self._db.write_batches, batches)
+
+      except asyncio.CancelledError:
+        raise
+
+      except Exception as e:
+        self._db.log_error(e)
+
+      finally:
+        for _ in batches:
+          self._scores.task_done()
+
+  async def _update_weights(self):
+
+    self._db.get_logger.info('Calling Callback read new model')
+
+    if await self._run_in(self._db_executor, self._db.update_weights, self._weights_file, self._update_directory):
+      self._network = await self._run_in(self._inference_executor, self._load_network, self._weights_file)
+      self._db.get_logger.info('MODEL LOADED')
+
+  async def _clear_log(self):
+
+    self._db.get_logger.info('Calling Callback clear log')
+    self._db.clear_log()
+
+  async def _score_history(self):
+
+    self._db.get_logger.info('Calling Callback score history log')
+    await self._run_in(self._db_executor, self._db.dump_score_history, self._update_directory)
+
+  async def run(self):
+    """
+    Run the service until the stop function is called.
+    """
+
+    # the event is created before the loop is published to stop (see stop)
+    self._stop = asyncio.Event()
+    self._loop = asyncio.get_event_loop()
+
+    if self._stop_requested.is_set():
+      self._stop.set()
+    self._messages = asyncio.Queue(maxsize=self._db.MAX_SIZE_QUEUE)
+    self._scores = asyncio.Queue(maxsize=self._db.MAX_SIZE_QUEUE)
+
+    # the maintenance tasks start after their first interval (as the scheduled callbacks)
+    producers = [asyncio.ensure_future(self._every(DT_READ_DB, self._read)),
+                 asyncio.ensure_future(self._every(DT_LOAD_NEW_WEIGHTS, self._update_weights, DT_LOAD_NEW_WEIGHTS)),
+                 asyncio.ensure_future(self._every(DT_CLEAR_LOG, self._clear_log, DT_CLEAR_LOG)),
+                 asyncio.ensure_future(self._every(DT_HISTORY_SCORE, self._score_history, DT_HISTORY_SCORE)),
+                ]
+    consumers = [asyncio.ensure_future(self._process()),
+                 asyncio.ensure_future(self._write()),
+                ]
+
+    self._db.get_logger.info('FILO BLU Service: STARTING UP')
+
+    try:
+      await self._stop.wait()
+
+    finally:
+
+      # no new messages: the messages already read are scored and written
+      for task in producers:
+        task.cancel()
+
+      await asyncio.gather(*producers, return_exceptions=True)
+
+      try:
+        await asyncio.wait_for(self._drain(), timeout=DT_STOP)
+      except asyncio.TimeoutError:
+        self._db.get_logger.warning('Shutdown: {} batches not processed'.format(self._messages.qsize() + self._scores.qsize()))
+
+      for task in consumers:
+        task.cancel()
+
+      await asyncio.gather(*consumers, return_exceptions=True)
+
+      self._db_executor.shutdown(wait=True)
+      self._inference_executor.shutdown(wait=True)
+
+      self._db.get_logger.info('FILO BLU Service: SHUTDOWN')
+
+  async def _drain(self):
+    await self._messages.join()
+    await self._scores.join()
+
+  def run_forever(self):
+    """
+    Run the service in a new event loop until the stop function is called.
+    A KeyboardInterrupt stops the service with the same shutdown sequence.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(self.run())
+
+    try:
+      loop.run_until_complete(task)
+
+    except KeyboardInterrupt:
+      self._stop_requested.set()
+
+      if self._stop is not None:
+        self._stop.set()
+
+      loop.run_until_complete(task)
+
+    finally:
+      loop.close()
+
+  def stop(self):
+    """
+    Stop the service (it can be called by any thread, also before the start of the service).
+    """
+    self._stop_requested.set()
+
+    loop = self._loop
+    if loop is not None:
+      try:
+        loop.call_soon_threadsafe(self._stop.set)
+
+      except RuntimeError: # the loop is already closed
+        pass
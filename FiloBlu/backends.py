@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import importlib
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# Registry of the available inference backends.
+# Each backend is given by the name of the module which implements the NetworkModel class with the
+# predict(text_list, bio_params, dictionary) member.
+# The modules are imported only when the backend is selected, so the heavy frameworks (ex. tensorflow)
+# are not loaded by the services which do not use them.
+
+BACKENDS = {
+            'np' : 'network_model_np',
+            'tf' : 'network_model_tf',
+           }
+
+DEFAULT_BACKEND = 'np'
+
+
+def register_backend(name, module):
+  """
+  Add a new inference backend to the registry.
+
+  ---------
+
+  Variables
+    - name : string - the backend name (the value of the 'backend' key in the config file)
+    - module : string - the name of the module which implements the NetworkModel class
+  """
+  BACKENDS[name] = module
+
+
+def get_backend(name=None):
+  """
+  Import the module of the given backend and return its NetworkModel class.
+
+  ---------
+
+  Variables
+    - name : string - the backend name (DEFAULT_BACKEND if None)
+
+  Return
+    - type - the NetworkModel class of the backend
+  """
+
+  name = name or DEFAULT_BACKEND
+
+  if name not in BACKENDS:
+    raise ValueError('Unknown backend {}. Available backends are {}'.format(name, sorted(BACKENDS)))
+
+  module = importlib.import_module(BACKENDS[name])
+  return module.NetworkModel
+
+
+def backend_from_config(config, default=DEFAULT_BACKEND):
+  """
+  Extract the backend name from the configuration.
+
+  ---------
+
+  Variables
+    - config : dict - the json configuration (the optional 'backend' key sets the backend)
+    - default : string - the backend used if the key is not set
+
+  Return
+    - string - the backend name
+  """
+  return config.get('backend', default)
+
+
+def load_network_model(name, weights_filename, **kwargs):
+  """
+  Create the network model of the given backend.
+
+  ---------
+
+  Variables
+    - name : string - the backend name
+    - weights_filename : string - the weights file of the network
+    - kwargs : dict - optional arguments of the backend NetworkModel constructor
+
+  Return
+    - object - the network model
+  """
+  return get_backend(name)(weights_filename, **kwargs)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# the following variables are measured in seconds !!!
+
+DT_BIO_CACHE_TTL = 60 * 60 # one hour
+
+# join of the measures with the parameter names and the measure times (used by all the queries)
+_MEASURES = 'FROM parametri_rilevati JOIN parametri \
+              ON (parametri_rilevati.id_parametro = parametri.id_parametro) \
+              JOIN parametri_rilevati_gruppo \
+              ON (parametri_rilevati.id_parametro_rilevato_gruppo = parametri_rilevati_gruppo.id_parametro_rilevato_gruppo) \
+              JOIN parametri_gruppi ON (parametri_gruppi.id_gruppo_parametro = parametri_rilevati_gruppo.id_gruppo)'
+
+_COLUMNS = 'SELECT parametri_rilevati.id_paziente, parametri_rilevati.valore, parametri.nome \
+            AS nome_parametro, parametri_rilevati_gruppo.data AS nome_gruppo '
+
+
+class BiologicalCache(object):
+  """
+  In-process cache of the last biological parameters of each patient.
+  Each entry stores the last value of each parameter of the patient and the time (parametri_rilevati_gruppo.data)
+  of the last measure read, i.e. the watermark of the patient.
+
+  The first request of a patient reads the last value of each parameter measured in the last `days` days;
+  the next requests read only the measures after the watermark, so the parameters of the patients already
+  seen cost (almost) nothing to the db.
+  The entries are fully re-loaded after ttl seconds: in this way the parameters which exit from the search
+  interval and the measures inserted with a time before the watermark are taken into account.
+  The least recently used entry is discarded when the cache is full.
+
+  --------
+
+  Members
+    - maxsize : int - max number of patients
+    - ttl : float - max life time of an entry in seconds
+    - days : int - search interval of the parameters in days (None for the whole history)
+    - hits : int - number of patients found in the cache (incremental update)
+    - misses : int - number of patients not found (or expired) in the cache (full load)
+  """
+
+  def __init__(self, maxsize=10000, ttl=DT_BIO_CACHE_TTL, days=None):
+    """
+    BiologicalCache constructor.
+
+    --------
+
+    Variables
+      - maxsize : int - max number of patients
+      - ttl : float - max life time of an entry in seconds
+      - days : int - search interval of the parameters in days (None for the whole history)
+    """
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.days = days
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict() # id_paziente -> [params, watermark, load time]
+    self._lock = threading.Lock()
+
+  def _load(self, cursor, patients, now):
+    # last value of each (patient, parameter) by a grouped max-date subquery
+
+    patients_fmt = ', '.join(['%s'] * len(patients))
+    params = [now]
+
+    lower_bound = ''
+    if self.days is not None:
+      lower_bound = 'AND parametri_rilevati_gruppo.data >= %s'
+      params.append(now - timedelta(days=self.days))
+
+    cursor.execute(_COLUMNS + _MEASURES + ' \
+                    JOIN (SELECT parametri_rilevati.id_paziente, parametri_rilevati.id_parametro, MAX(parametri_rilevati_gruppo.data) AS data \
+                          FROM parametri_rilevati JOIN parametri_rilevati_gruppo \
+                          ON (parametri_rilevati.id_parametro_rilevato_gruppo = parametri_rilevati_gruppo.id_parametro_rilevato_gruppo) \
+                          WHERE parametri_rilevati.id_paziente IN ({0}) \
+                          AND parametri_rilevati_gruppo.data <= %s {1} \
+                          GROUP BY parametri_rilevati.id_paziente, parametri_rilevati.id_parametro) AS last_measure \
+                    ON (parametri_rilevati.id_paziente = last_measure.id_paziente \
+                        AND parametri_rilevati.id_parametro = last_measure.id_parametro \
+                        AND parametri_rilevati_gruppo.data = last_measure.data) \
+                    WHERE parametri_rilevati.id_paziente IN ({0}) \
+                    ORDER BY parametri_rilevati_gruppo.data'.format(patients_fmt, lower_bound),
+                    patients + params + patients)
+
+    return cursor.fetchall()
+
+  def _update(self, cursor, watermarks, now):
+    # measures after the watermark of each patient (a single min watermark would read the old measures
+    # of all the patients, ex. the whole search interval because of the patients without parameters)
+
+    patients = list(watermarks)
+    patients_fmt = ', '.join(['%s'] * len(patients))
+    since_fmt = ' OR '.join(['(parametri_rilevati.id_paziente = %s AND parametri_rilevati_gruppo.data > %s)'] * len(patients))
+    since = [value for patient in patients for value in (patient, watermarks[patient])]
+
+    cursor.execute(_COLUMNS + _MEASURES + ' \
+                    WHERE parametri_rilevati.id_paziente IN ({0}) AND ({1}) \
+                    AND parametri_rilevati_gruppo.data <= %s \
+                    ORDER BY parametri_rilevati_gruppo.data'.format(patients_fmt, since_fmt),
+                    patients + since + [now])
+
+    return cursor.fetchall()
+
+  def get(self, cursor, patients, now):
+    """
+    Get the biological parameters of the given patients.
+    The missing (or expired) patients are read by a single query and the other ones are updated by a
+    single incremental query.
+
+    --------
+
+    Variables
+      - cursor : cursor type - the db cursor
+      - patients : iterable - the id of the patients
+      - now : datetime - the measures after this time are not considered
+
+    Return
+      - dict - the biological parameters of each patient (parameter name -> value) with the time of the
+               last measure (storage_time key); the patients without parameters are not included
+    """
+
+    with self._lock:
+
+      clock = time.monotonic()
+      to_load, to_update = [], []
+
+      for patient in set(patients):
+        entry = self._entries.get(patient)
+
+        if entry is None or clock - entry[2] > self.ttl:
+          to_load.append(patient)
+        else:
+          to_update.append(patient)
+
+      self.hits += len(to_update)
+      self.misses += len(to_load)
+
+      if to_update:
+        watermarks = {patient : self._entries[patient][1] for patient in to_update}
+
+        for patient_bio, patient_bioval, patient_param, bio_time in self._update(cursor, watermarks, now):
+          params, _, _ = entry = self._entries[patient_bio]
+          params[patient_param] = float(patient_bioval)
+          params['storage_time'] = bio_time
+          entry[1] = bio_time
+
+      if to_load:
+        # the patients without parameters are updated starting from the begin of the search interval
+        start = now - timedelta(days=self.days) if self.days is not None else now.replace(year=1, month=1, day=1)
+        loaded = {patient : [{}, start, clock] for patient in to_load}
+
+        for patient_bio, patient_bioval, patient_param, bio_time in self._load(cursor, to_load, now):
+          params, _, _ = entry = loaded[patient_bio]
+          params[patient_param] = float(patient_bioval)
+          params['storage_time'] = bio_time
+          entry[1] = bio_time
+
+        self._entries.update(loaded)
+
+      result = {}
+
+      for patient in set(patients):
+        self._entries.move_to_end(patient)
+        params = self._entries[patient][0]
+
+        if params:
+          result[patient] = dict(params)
+
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+      return result
+
+  def clear(self):
+    """
+    Remove all the entries and reset the counters.
+    """
+    with self._lock:
+      self._entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def info(self):
+    """
+    Get the statistics of the cache.
+
+    --------
+
+    Return
+      - dict - hits, misses, current and max number of entries
+    """
+    with self._lock:
+      return {'hits' : self.hits, 'misses' : self.misses, 'size' : len(self._entries), 'maxsize' : self.maxsize}
+
+  def __len__(self):
+    return len(self._entries)
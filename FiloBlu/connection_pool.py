@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import mysql.connector
+from collections import deque
+from contextlib import contextmanager
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+class ConnectionPool(object):
+  """
+  Thread-safe pool of persistent MySQL connections.
+  The connections are opened on demand (up to size) and reused by the callers, so the TCP + authentication
+  handshake is paid only once per connection.
+  Each checkout gets a connection for the exclusive use of the caller (connections and cursors are never
+  shared between threads); if all the connections are in use the caller waits up to timeout seconds.
+
+  The connections are opened in autocommit mode with the READ COMMITTED isolation level: each query
+  sees the rows committed before it, so a long-lived connection does not read a stale snapshot (the
+  default REPEATABLE READ level keeps the snapshot of the first read until the transaction ends).
+  The writes must be enclosed in an explicit transaction (start_transaction / commit).
+
+  A connection idle for more than ping_interval seconds is checked (ping) at the checkout and it is
+  re-connected if the server closed it.
+
+  --------
+
+  Members
+    - size : int - max number of connections
+    - timeout : float - max waiting time of a checkout in seconds
+    - ping_interval : float - idle time in seconds after which the connection is checked
+  """
+
+  ISOLATION_LEVEL = 'READ COMMITTED'
+  RECONNECT_ATTEMPTS = 3
+  RECONNECT_DELAY = 1 # seconds
+
+  def __init__(self, config, size=4, timeout=30., ping_interval=30.):
+    """
+    ConnectionPool constructor.
+
+    --------
+
+    Variables
+      - config : dict - the db credentials (host, username, password and database keys)
+      - size : int - max number of connections
+      - timeout : float - max waiting time of a checkout in seconds
+      - ping_interval : float - idle time in seconds after which the connection is checked
+    """
+
+    if size < 1:
+      raise ValueError('The pool size must be at least 1. Given {}'.format(size))
+
+    self._config = {'host' : config['host'],
+                    'user' : config['username'],
+                    'passwd' : config['password'],
+                    'database' : config['database'],
+                    'autocommit' : True
+                    }
+
+    self.size = size
+    self.timeout = timeout
+    self.ping_interval = ping_interval
+
+    self._idle = deque() # (connection, last use time)
+    self._created = 0
+    self._cond = threading.Condition()
+
+    self._stats = {'checkouts' : 0, 'waits' : 0, 'wait_time' : 0., 'reconnects' : 0, 'discarded' : 0}
+
+  def _setup(self, conn):
+    cursor = conn.cursor()
+    cursor.execute('SET SESSION TRANSACTION ISOLATION LEVEL {}'.format(self.ISOLATION_LEVEL))
+    cursor.close()
+    return conn
+
+  def _connect(self):
+    return self._setup(mysql.connector.connect(**self._config))
+
+  def _check(self, conn, last_use):
+
+    if time.monotonic() - last_use < self.ping_interval:
+      return conn
+
+    try:
+      conn.ping(reconnect=False)
+
+    except mysql.connector.Error:
+      conn.reconnect(attempts=self.RECONNECT_ATTEMPTS, delay=self.RECONNECT_DELAY)
+      self._setup(conn)
+
+      with self._cond:
+        self._stats['reconnects'] += 1
+
+    return conn
+
+  def _acquire(self):
+
+    with self._cond:
+
+      self._stats['checkouts'] += 1
+
+      if not self._idle and self._created >= self.size:
+        self._stats['waits'] += 1
+        start = time.monotonic()
+
+        if not self._cond.wait_for(lambda : self._idle or self._created < self.size, timeout=self.timeout):
+          raise TimeoutError('No connection available in the pool after {} seconds'.format(self.timeout))
+
+        self._stats['wait_time'] += time.monotonic() - start
+
+      if self._idle:
+        conn, last_use = self._idle.pop()
+
+      else:
+        self._created += 1
+        conn, last_use = None, None
+
+    try:
+      return self._connect() if conn is None else self._check(conn, last_use)
+
+    except Exception:
+      self._discard(conn)
+      raise
+
+  def _release(self, conn):
+
+    with self._cond:
+      self._idle.append((conn, time.monotonic()))
+      self._cond.notify()
+
+  def _discard(self, conn):
+
+    if conn is not None:
+      try:
+        conn.close()
+      except Exception:
+        pass
+
+    with self._cond:
+      self._created -= 1
+      self._stats['discarded'] += 1
+      self._cond.notify()
+
+  @contextmanager
+  def connection(self):
+    """
+    Checkout a connection for the exclusive use of the caller.
+    The connection is returned to the pool at the end of the with block.
+    After an exception the connection is discarded if the error comes from the link (OperationalError,
+    InterfaceError); otherwise the open transaction is rolled back and the connection is checked (ping)
+    before it is returned to the pool, so a broken connection is never reused (a new one will be opened
+    by the next checkout).
+
+    --------
+
+    Example
+      with pool.connection() as db:
+        cursor = db.cursor()
+        cursor.execute(query)
+    """
+
+    conn = self._acquire()
+
+    try:
+      yield conn
+
+    except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError):
+      # the link is lost (the in_transaction flag is client-side, so it can not be trusted)
+      self._discard(conn)
+      raise
+
+    except Exception:
+
+      try:
+        if conn.in_transaction:
+          conn.rollback()
+
+        conn.ping(reconnect=False)
+
+      except mysql.connector.Error:
+        self._discard(conn)
+
+      else:
+        self._release(conn)
+
+      raise
+
+    else:
+      self._release(conn)
+
+  def close(self):
+    """
+    Close all the idle connections.
+    """
+    with self._cond:
+      while self._idle:
+        conn, _ = self._idle.pop()
+        self._created -= 1
+
+        try:
+          conn.close()
+        except Exception:
+          pass
+
+  def stats(self):
+    """
+    Get the statistics of the pool.
+
+    --------
+
+    Return
+      - dict - number of connections (opened, in use and idle), number of checkouts, number and total time
+               (seconds) of the checkouts which waited for a free connection, number of reconnections and of
+               discarded (broken) connections
+    """
+    with self._cond:
+      stats = dict(self._stats)
+      stats.update({'size' : self.size,
+                    'opened' : self._created,
+                    'in_use' : self._created - len(self._idle),
+                    'idle' : len(self._idle)
+                    })
+      return stats
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+import os
+import numpy as np
+
+from weights_format import LAYERS, save_weights
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# global variables that must be set and used in the following class
+# The paths are relative to the current python file
+DICTIONARY = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'updated_dictionary.dat'))
+MODEL = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'dual_w_0_2_class_ind_cw.h5'))
+
+# default corpus used for the verification of the converted weights
+SAMPLE_CORPUS = [
+                 'buongiorno dottore oggi ho la febbre alta e un fortissimo dolore al rene da una settimana',
+                 'ciao e tanti auguri di buon natale a lei e famiglia',
+                 'buongiorno dottore',
+                 'ho misurato la pressione stamattina ed era molto alta, devo aumentare la terapia?',
+                 'grazie mille dottore, sto meglio',
+                 '',
+                ]
+
+
+def read_h5_weights(h5_filename, layers=LAYERS):
+  """
+  Read the weights of the Dense layers from the Keras HDF5 file.
+  Both the files written by model.save_weights and by model.save are supported.
+
+  ---------
+
+  Variables
+    - h5_filename : string - the Keras weights filename
+    - layers : list - the names of the Dense layers to read
+
+  Return
+    - model : list - the list of arrays (kernel, bias) of each layer in the layers order (as the pickle file)
+  """
+
+  import h5py
+
+  model = []
+
+  with h5py.File(h5_filename, 'r') as fp:
+
+    root = fp['model_weights'] if 'model_weights' in fp else fp
+
+    for layer in layers:
+
+      if layer not in root:
+        raise ValueError('The layer {} is not stored in the file {}'.format(layer, h5_filename))
+
+      group = root[layer]
+      names = [n.decode('utf-8') if isinstance(n, bytes) else n for n in group.attrs['weight_names']]
+      params = {os.path.basename(n).split(':')[0] : np.asarray(group[n]) for n in names}
+
+      model.extend([params['kernel'], params['bias']])
+
+  return model
+
+
+def compare_backends(np_model, tf_model, text_list, dictionary):
+  """
+  Evaluate the two network models on the same corpus and compare their outputs.
+
+  ---------
+
+  Variables
+    - np_model : object - the numpy network model
+    - tf_model : object - the tensorflow network model
+    - text_list : list - the text messages of the corpus
+    - dictionary : dict - a dictionary in which keys are words and value are integer (freq order)
+
+  Return
+    - report : dict - max absolute difference of the probabilities and number of different classes of each output
+  """
+
+  np_pred = np_model.predict_full(text_list, None, dictionary)
+  tf_pred = tf_model.predict_full(text_list, None, dictionary)
+
+  num_messages = len(np_pred)
+
+  return {'messages' : num_messages,
+          'max_diff_type' : float(np.abs(np_pred.topic_proba - tf_pred.topic_proba).max()) if num_messages else 0.,
+          'max_diff_pred' : float(np.abs(np_pred.priority_proba - tf_pred.priority_proba).max()) if num_messages else 0.,
+          'changed_topic' : int(np.sum(np_pred.topic != tf_pred.topic)),
+          'changed_priority' : int(np.sum(np_pred.priority != tf_pred.priority)),
+          }
+
+
+def convert(h5_filename, filename, dtype=None):
+  """
+  Convert the Keras HDF5 weights file in the memory-mapped weights format of the numpy network.
+
+  ---------
+
+  Variables
+    - h5_filename : string - the Keras weights filename
+    - filename : string - the output filename
+    - dtype : type - optional data type of the stored arrays (the original one is used if None)
+  """
+  save_weights(read_h5_weights(h5_filename), filename, dtype=dtype)
+
+
+def parse_args():
+  """
+  Just a simple parser of the command line.
+  There are not required parameters because the scripts can run also with the
+  set of default variables set at the beginning of this script.
+
+  -----
+
+  Return
+
+    args : object - Each member of the object identify a different command line argument (properly casted)
+  """
+
+  import argparse
+
+  description = 'Filo Blu weights converter (Keras .h5 -> numpy memory-mapped format)'
+
+  parser = argparse.ArgumentParser(description = description)
+  parser.add_argument('--input',
+                      dest='input',
+                      type=str,
+                      required=False,
+                      action='store',
+                      help='Keras weights filename',
+                      default=MODEL
+                      )
+  parser.add_argument('--output',
+                      dest='output',
+                      type=str,
+                      required=False,
+                      action='store',
+                      help='Output weights filename (default: input filename with .fbw extension)',
+                      default=None
+                      )
+  parser.add_argument('--dtype',
+                      dest='dtype',
+                      type=str,
+                      required=False,
+                      action='store',
+                      help='Data type of the stored arrays (ex. float32)',
+                      default=None
+                      )
+  parser.add_argument('--dictionary',
+                      dest='dictionary',
+                      type=str,
+                      required=False,
+                      action='store',
+                      help='Word dictionary sorted by frequency',
+                      default=DICTIONARY
+                      )
+  parser.add_argument('--corpus',
+                      dest='corpus',
+                      type=str,
+                      required=False,
+                      action='store',
+                      help='Text file with a message for each line used to verify the conversion',
+                      default=None
+                      )
+  parser.add_argument('--no_verify',
+                      dest='verify',
+                      required=False,
+                      action='store_false',
+                      help='Skip the comparison between the Keras and the numpy models',
+                      default=True
+                      )
+
+  args = parser.parse_args()
+  args.input = os.path.abspath(args.input)
+  args.output = os.path.abspath(args.output) if args.output else os.path.splitext(args.input)[0] + '.fbw'
+  args.dictionary = os.path.abspath(args.dictionary)
+
+  return args
+
+
+if __name__ == '__main__':
+
+  args = parse_args()
+
+  convert(args.input, args.output, dtype=args.dtype)
+
+  print('Weights converted: {} -> {}'.format(args.input, args.output))
+
+  if args.verify:
+
+    from misc import read_dictionary
+    from backends import load_network_model
+
+    dictionary = read_dictionary(args.dictionary)
+
+    if args.corpus:
+      with open(args.corpus, 'r', encoding='utf-8') as fp:
+        text_list = [line.rstrip('\n') for line in fp]
+    else:
+      text_list = SAMPLE_CORPUS
+
+    precision = 'float32' if args.dtype == 'float32' else 'float64'
+
+    report = compare_backends(load_network_model('np', args.output, precision=precision),
+                              load_network_model('tf', args.input),
+                              text_list, dictionary)
+
+    print('Verification on {messages} messages'.format(**report))
+    print('  max probability difference (type)     : {max_diff_type:.3e}'.format(**report))
+    print('  max probability difference (priority) : {max_diff_pred:.3e}'.format(**report))
+    print('  different topic classes               : {changed_topic}'.format(**report))
+    print('  different priority classes            : {changed_priority}'.format(**report))
+
+    if report['changed_topic'] or report['changed_priority']:
+      print('WARNING: the numpy and the Keras models disagree')
+      exit(1)
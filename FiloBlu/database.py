@@ -3,15 +3,21 @@
 
 import os
 import json
+import time
 import glob
 import logging
 import operator
+import threading
 import mysql.connector
-from queue import Queue
-from collections import defaultdict
+from queue import Queue, Empty
+from collections import deque, Counter
 from datetime import datetime, timedelta
+from mysql.connector import errorcode
 
-from misc import repeat_interval
+from connection_pool import ConnectionPool
+from bio_cache import BiologicalCache, DT_BIO_CACHE_TTL
+from message_batch import MessageBatch, MessageBatchAssembler
+from scheduler import Scheduler, scheduled, FIXED_DELAY
 from radar_plot import radar_plot
 
 __author__ = 'Nico Curti'
@@ -20,17 +26,43 @@ __email__ = 'nico.curti2@unibo.it'
 # the following variables are measured in seconds !!!
 
 DT_READ_DB = 40
-DT_PROCESS_MESSAGE = 50
-DT_WRITE_SCORE_MESSAGES = 60
+DT_PROCESS_MESSAGE = 5 # max waiting time for new messages (the process stage runs as soon as they arrive)
+DT_WRITE_SCORE_MESSAGES = 5 # max waiting time for new scores (the write stage runs as soon as they arrive)
 DT_LOAD_NEW_WEIGHTS = 24 * 60 * 60 # one day
 DT_CLEAR_LOG = 24 * 60 * 60 # one day
 DT_HISTORY_SCORE = 24 * 60 * 60 * 10 # 10 days
 
 DT_BIOLOGICAL_SEARCH = 200 # measured in days (confidence interval for query of biological parameters)
+DT_WRITE_RETRY = .5 # seconds of the first wait before retrying a write (doubled at each retry)
+DT_PROCESS_MAX_WAIT = 1 # max waiting time for new batches to merge before the network evaluation
+DT_MAINTENANCE_JITTER = 60 # max random delay of the daily jobs (they do not start all together)
+DT_STOP = 30 # max waiting time for the running jobs (or the queued messages of the asyncio runtime) at the stop of the service
 
 class FiloBluDB(object):
 
   MAX_SIZE_QUEUE = 100
+  POOL_SIZE = 4 # one connection for each concurrent callback (read, write, history) + one spare
+  WRITE_CHUNK_SIZE = 500 # max number of scores written (and committed) by a single transaction
+  WRITE_RETRIES = 3 # max number of retries of a chunk after a deadlock or a lock wait timeout
+
+  # errors of a transaction which can be safely retried
+  RETRY_ERRORS = (errorcode.ER_LOCK_DEADLOCK, errorcode.ER_LOCK_WAIT_TIMEOUT)
+
+  # the scores are written in a per-connection temporary table (same column types of messaggi)
+  # and then copied in the messaggi table by a single UPDATE ... JOIN
+  STAGING_TABLE = 'sa_score_staging'
+
+  READ_PAGE_SIZE = 512 # max number of messages read by a single query (one queued batch)
+  BIO_CACHE_SIZE = 10000 # max number of patients in the cache of the biological parameters
+  PROCESS_BATCH_SIZE = 4096 # target number of messages evaluated by a single network call
+
+  # the watermark is the (scritto_il, id_paziente) key of the last scored message;
+  # it is stored in this file (next to the config file) if the "watermark_file" field is not set
+  WATERMARK_FILE = 'filoblu_watermark.json'
+  WATERMARK_TIME_FMT = '%Y-%m-%d %H:%M:%S.%f'
+
+  # jobs paused by callback_load_new_weights until the network model is reloaded (see set_network)
+  RELOAD_JOBS = ('callback_read_last_messages', 'callback_process_messages')
 
   def __init__(self, config, logfile):
     """
@@ -45,11 +77,17 @@ class FiloBluDB(object):
                             "password" : "db_pwd",
                             "database" : "db_name"
 
+                          and the optional fields "pool_size" (max number of db connections, POOL_SIZE by default),
+                          "write_chunk_size" (max number of scores committed together, WRITE_CHUNK_SIZE by default),
+                          "read_page_size" (max number of messages read together, READ_PAGE_SIZE by default),
+                          "bio_cache_size" (max number of patients in the cache, BIO_CACHE_SIZE by default),
+                          "bio_cache_ttl" (life time in seconds of the cached parameters, DT_BIO_CACHE_TTL by default),
+                          "process_batch_size" (messages evaluated together by the network, PROCESS_BATCH_SIZE by default)
+                          and "watermark_file" (filename of the persisted watermark, WATERMARK_FILE by default).
+
       - logfile : string - log filename in which the stdout and stderr are dumped.
     """
 
-    self._wait = False
-
     self._logfilename = logfile
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
@@ -64,23 +102,49 @@ class FiloBluDB(object):
     mpl_logger = logging.getLogger('matplotlib')
     mpl_logger.setLevel(logging.WARNING)
 
+    # all the callbacks are jobs of this scheduler (see the scheduled decorator)
+    self._scheduler = Scheduler(on_error=self.log_error)
+    # the main loop of the service waits on these events (see wait_reload)
+    self._reload_event = threading.Event() # set by callback_load_new_weights (and by stop to wake up the main loop)
+    self._stop_event = threading.Event()
+
     try:
 
       with open(config, 'r', encoding='utf-8') as fp:
         self.config = json.load(fp)
 
-      self._db = mysql.connector.connect(
-                                        host = self.config['host'],
-                                        user = self.config['username'],
-                                        passwd = self.config['password'],
-                                        database = self.config['database']
-                                        )
-      self._logger.info ('CONNECTION DB ESTABLISHED')
-
-      self._cursor = self._db.cursor()
-      self._cursor.execute('SHOW columns FROM messaggi')
-      self._key_id = map(operator.itemgetter(0), self._cursor)
-      self._data = {k : [] for k in self._key_id} # I don't know why but without you the program crash
+      self._watermark_file = self.config.get('watermark_file',
+                                             os.path.join(os.path.dirname(os.path.abspath(config)), self.WATERMARK_FILE))
+      self._watermark = self._load_watermark()
+      # key of the last message read (and queued): it is ahead of the watermark until the scores are written
+      self._read_position = self._watermark
+      # ids of the messages with the same key of the read position which are already read: the messages
+      # with the same (scritto_il, id_paziente) key can be split between two pages (see _read_messages_page)
+      self._read_ties = ()
+      # [read position before the page, first key, last key, written] of each batch read and not yet
+      # written in the read order: the watermark moves only over the written batches at its head
+      self._in_flight = deque()
+      self._in_flight_lock = threading.Lock()
+      self._read_generation = 0 # incremented by each rewind of the read position (see _rewind)
+
+      self._bio_cache = BiologicalCache(maxsize=self.config.get('bio_cache_size', self.BIO_CACHE_SIZE),
+                                        ttl=self.config.get('bio_cache_ttl', DT_BIO_CACHE_TTL),
+                                        days=DT_BIOLOGICAL_SEARCH)
+
+      self._pool = ConnectionPool(self.config, size=self.config.get('pool_size', self.POOL_SIZE))
+
+      with self._pool.connection() as db:
+        self._logger.info ('CONNECTION DB ESTABLISHED')
+
+        cursor = db.cursor()
+        cursor.execute('SHOW columns FROM messaggi')
+        columns = cursor.fetchall()
+        self._key_id = list(map(operator.itemgetter(0), columns))
+        # the primary key identifies the messages with the same key (the text if there is no single-column primary key)
+        primary = [column[0] for column in columns if column[3] == 'PRI']
+        self._message_id = primary[0] if len(primary) == 1 else 'testo'
+
+      self._data = {k : [] for k in self._key_id}
       self._queue = Queue(maxsize=self.MAX_SIZE_QUEUE)
       self._score = Queue(maxsize=self.MAX_SIZE_QUEUE)
 
@@ -89,100 +153,214 @@ class FiloBluDB(object):
       self.log_error(e)
 
 
-  @repeat_interval(DT_READ_DB)
+  @scheduled(DT_READ_DB)
   def callback_read_last_messages(self):
     """
     Callback function.
-    This function evaluate the current time and it executes a query on the db filtering by the time
-    (keyword 'scritto_il').
+    This function reads the messages without score (sa_score = 0) written after the last read one.
+    The messages are ordered by the (scritto_il, id_paziente) key and they are read in pages of
+    (at most) read_page_size messages starting from the key of the last read message (keyset pagination),
+    so each message is read only one time and the backlog of messages accumulated while the service was
+    down is consumed page by page. The messages with the same key split between two pages are told apart
+    by the primary key of messaggi (see _read_messages_page).
+    At the start-up the reading starts from the persisted watermark, i.e. the key of the last message
+    whose score was written (see callback_write_score_messages): the messages read but not scored before
+    a stop of the service are read again. If there is no watermark the messages of the last DT_READ_DB * 5
+    seconds are read.
     This method is tuned over the FiloBluDB format db and the query must be changed if you run on
     different database.
     If some new messages are found the extraction of biological parameters associated to each patient
     is performed considering a time interval (confidence interval for biological variables update) of 2 days.
     The extracted records are then re-organized inside the 'text_msg' variable and processed by the
     neural network algorithm to extract the score values.
-    The variables are stored in a queue array for FIFO management of the data.
+    Each page of messages is stored in a queue array for FIFO management of the data: the process stage
+    waits on this queue, so the messages are processed as soon as they are read.
 
-    The function is called every DT_READ_DB seconds.
+    The function is called every DT_READ_DB seconds (fixed-rate job of the scheduler).
     """
 
-    if not self._wait:
+    self._logger.info('Calling Callback message')
 
-      self._logger.info('Calling Callback message')
+    try:
 
-      try:
+      # the connection is released before waiting for a free slot in the queue
+      for batch in self.read_pages():
+        self._queue.put(batch) # text + biological values
+
+      self._logger.debug('Connection pool: {}'.format(self._pool.stats()))
+      self._logger.debug('Biological parameters cache: {}'.format(self._bio_cache.info()))
+      self._logger.debug('Scheduler: {}'.format(self._scheduler.stats()))
+
+    except Exception as e:
+
+      self.log_error(e)
+
+
+  def read_pages(self):
+    """
+    Read the new messages page by page (see callback_read_last_messages).
+    The read position is moved to the end of each page and the page is tracked until its scores are
+    written (see _advance_watermark). If the read position is rewound by a failure (see _rewind) the
+    generator stops: the pages are read again from the rewound position by the next call.
+
+    ---------
+
+    Return
+      - generator - the MessageBatch of each (non-empty) page
+    """
+
+    now = datetime.now()
+    page_size = self.config.get('read_page_size', self.READ_PAGE_SIZE)
+    generation = self._read_generation
+
+    if self._read_position is None:
+      self._read_position = (now - timedelta(seconds=DT_READ_DB * 5), -1)
+
+    num_messages = page_size
 
-        now = datetime.now()
-        interval_time = now - timedelta(seconds=DT_READ_DB * 5)
+    while num_messages == page_size:
 
-        # I do not know why but if I do not re-connect to the db the queries are always None
+      # the pooled connections run in autocommit mode, so each query sees the last committed messages
+      with self._pool.connection() as db:
+        batch, ties = self._read_messages_page(db.cursor(), now, page_size)
 
-        self._db = mysql.connector.connect(
-                                            host = self.config['host'],
-                                            user = self.config['username'],
-                                            passwd = self.config['password'],
-                                            database = self.config['database']
-                                          )
-        self._cursor = self._db.cursor()
+      num_messages = len(batch)
+      self._logger.info('Found {} messages to process'.format(num_messages))
 
-        self._cursor.execute('SELECT id_paziente, testo, scritto_il FROM messaggi WHERE scritto_il < "{0}" AND scritto_il >= "{1}" AND sa_score = 0'.format(
-                              now, interval_time))
-        # self._cursor.execute('SELECT id_paziente, testo, scritto_il FROM messaggi WHERE scritto_il < "{0}"'.format(now)) # FOR DEBUG
-        result_query = self._cursor.fetchall()
+      if not batch:
+        break
 
-        self._logger.info('Found {} messages to process'.format(len(result_query)))
+      with self._in_flight_lock:
 
-        if result_query:
+        if generation != self._read_generation:
+          return
 
-          patient_msg, text_msg, time_msg = zip(*result_query)
+        self._in_flight.append([self._read_position, batch.first_key, batch.last_key, False])
+        self._read_position = batch.last_key
+        self._read_ties = ties
 
-          # looking for biological parameters
-          bio_interval_time  = now - timedelta(days=DT_BIOLOGICAL_SEARCH)
-          self._cursor.execute('SELECT parametri_rilevati.id_paziente, parametri_rilevati.valore, parametri.nome \
-                                AS nome_parametro, parametri_rilevati_gruppo.data AS nome_gruppo \
-                                FROM parametri_rilevati JOIN parametri \
-                                ON (parametri_rilevati.id_parametro = parametri.id_parametro) \
-                                JOIN parametri_rilevati_gruppo \
-                                ON (parametri_rilevati.id_parametro_rilevato_gruppo = parametri_rilevati_gruppo.id_parametro_rilevato_gruppo) \
-                                JOIN parametri_gruppi ON (parametri_gruppi.id_gruppo_parametro = parametri_rilevati_gruppo.id_gruppo) \
-                                WHERE parametri_rilevati_gruppo.data <= "{0}" \
-                                AND parametri_rilevati_gruppo.data >= "{1}"'.format(now, bio_interval_time))
+      yield batch
 
-          # patient_bio, patient_bioval, patient_param, bio_time = zip(*self._cursor.fetchall())
 
-          result_query = defaultdict(dict)
-          for patient_bio, patient_bioval, patient_param, bio_time in self._cursor.fetchall():
-            result_query[patient_bio][patient_param] = float(patient_bioval)
-            result_query[patient_bio]['storage_time'] = bio_time
+  def _read_messages_page(self, cursor, now, page_size):
+    """
+    Read the next page of messages after the current read position and their biological parameters.
+    The (scritto_il, id_paziente) key is not unique (a patient can write two messages in the same second),
+    so the messages with the key of the read position are read again and the ones already read (see
+    _read_ties) are dropped by their id (the primary key of messaggi).
+
+    ---------
+
+    Variables
+      - cursor : cursor type - the db cursor
+      - now : datetime - the messages written after this time are not read
+      - page_size : int - max number of messages
+
+    Return
+      - MessageBatch - the messages in the key order with the biological parameters of their patients
+      - tuple - the ids of the messages with the last key of the page
+    """
 
-          data_to_process = [None] * len(patient_msg)
+    position = self._read_position
+    last_time, last_patient = position
+    read = Counter(self._read_ties)
+    ties = []
 
-          for i, patient in enumerate(patient_msg):
-            for bio_patient, bio_params in result_query.items():
-              if patient == bio_patient:
-                data_to_process[i] = (text_msg[i], patient_msg[i], bio_params, time_msg[i])
-                break
+    cursor.execute('SELECT id_paziente, testo, scritto_il, {0} FROM messaggi \
+                    WHERE sa_score = 0 AND scritto_il < %s \
+                    AND (scritto_il > %s OR (scritto_il = %s AND id_paziente >= %s)) \
+                    ORDER BY scritto_il, id_paziente LIMIT %s'.format(self._message_id),
+                   (now, last_time, last_time, last_patient, page_size + len(self._read_ties)))
 
-            if data_to_process[i] is None:
-              data_to_process[i] = (text_msg[i], patient_msg[i], None, time_msg[i])
+    def rows():
+      # the messages already read are dropped and the ids of the last key are collected
+      key = None
+      size = 0
 
-          self._queue.put(data_to_process) # text + biological values
+      for patient, text, msg_time, message_id in cursor:
 
-      except Exception as e:
+        if (msg_time, patient) == position and read[message_id]:
+          read[message_id] -= 1
+          continue
 
-        self.log_error(e)
+        if size == page_size:
+          continue # the cursor is consumed, so it can be used for the biological parameters
 
+        size += 1
 
-  @repeat_interval(DT_PROCESS_MESSAGE)
+        if (msg_time, patient) != key:
+          key = (msg_time, patient)
+          ties.clear()
+
+        ties.append(message_id)
+        yield patient, text, msg_time
+
+    # the messages are streamed from the cursor and joined with the (cached) biological parameters
+    assembler = MessageBatchAssembler(lambda patients : self._bio_cache.get(cursor, patients, now))
+    batch = assembler.assemble(rows())
+
+    if batch and batch.last_key == position:
+      ties.extend(self._read_ties)
+
+    return batch, tuple(ties)
+
+
+  def _load_watermark(self):
+    """
+    Read the persisted watermark.
+
+    ---------
+
+    Return
+      - tuple - the (scritto_il, id_paziente) key of the last scored message (None if there is no watermark)
+    """
+
+    if not os.path.isfile(self._watermark_file):
+      return None
+
+    with open(self._watermark_file, 'r', encoding='utf-8') as fp:
+      watermark = json.load(fp)
+
+    return (datetime.strptime(watermark['scritto_il'], self.WATERMARK_TIME_FMT), watermark['id_paziente'])
+
+
+  def _save_watermark(self, watermark):
+    """
+    Persist the watermark.
+    The file is replaced atomically, so a stop of the service never leaves a partial watermark.
+
+    ---------
+
+    Variables
+      - watermark : tuple - the (scritto_il, id_paziente) key of the last scored message
+    """
+
+    scritto_il, id_paziente = watermark
+    tmp_file = self._watermark_file + '.tmp'
+
+    with open(tmp_file, 'w', encoding='utf-8') as fp:
+      json.dump({'scritto_il' : scritto_il.strftime(self.WATERMARK_TIME_FMT), 'id_paziente' : id_paziente}, fp)
+
+    os.replace(tmp_file, self._watermark_file)
+    self._watermark = watermark
+
+
+  @scheduled(0, mode=FIXED_DELAY, delay=0)
   def callback_process_messages(self, network, dictionary):
     """
     Callback function.
-    This function evaluate the last inserted data in the queue container and
+    This function waits for the data inserted in the queue container by the read callback and
     it creates the radar plot of biological parameters.
-    If there are new data to process the pair of (msg, biological params) are given to the NN
-    and the score are stored in an other FIFO containter.
+    The pair of (msg, biological params) are given to the NN and the score are stored in an other
+    FIFO containter.
+    Both the network outputs (priority score and topic with their probabilities) are computed by
+    a single call and they are stored together.
+    The queued batches are merged (see _next_batches) and evaluated by a single network call; the
+    results are split back and each source batch is stored in the FIFO container of the scores.
 
-    The function is called every DT_PROCESS_MESSAGE seconds.
+    The function is a fixed-delay job of the scheduler called again as soon as it returns: each call waits
+    (up to DT_PROCESS_MESSAGE seconds) for new data, so the messages are processed as soon as they are read.
+    The job is paused while the network model is reloaded (see set_network).
 
     -----------
 
@@ -191,38 +369,108 @@ class FiloBluDB(object):
       dictionary: dict - a dictionary in which keys are words and value are integer (freq order)
     """
 
-    if not self._wait:
+    try:
+
+      # Tensorflow does not work in thread!!! BUG
+      #self._score = [42]
+      batches = self._next_batches(timeout=DT_PROCESS_MESSAGE)
+
+      if not batches:
+        return
 
       self._logger.info('Calling Callback process message')
 
-      try:
+      for scored in self.score_batches(batches, network, dictionary):
+        self._score.put(scored)
 
-        if not self._queue.empty():
+    except Exception as e:
 
-          # Tensorflow does not work in thread!!! BUG
-          #self._score = [42]
-          data_to_process = self._queue.get()
+      self.log_error(e)
+
+
+  def score_batches(self, batches, network, dictionary):
+    """
+    Evaluate the network on a list of batches with a single call.
+    The batches are merged, the radar plots of the biological parameters are saved and the scores are
+    split back and attached to each batch.
+
+    ---------
+
+    Variables
+      - batches : list - the MessageBatch to evaluate
+      - network : object - the neural network object (as tensorflow model or the numpy one)
+      - dictionary : dict - a dictionary in which keys are words and value are integer (freq order)
+
+    Return
+      - list - the scored batches in the same order
+
+    If the evaluation fails the read position is rewound (see _rewind), so the messages are read again.
+    """
+
+    batch = MessageBatch.concatenate(batches) if len(batches) > 1 else batches[0]
+
+    try:
+
+      # save radar plot of biological parameters
+
+      radar_plot(batch.bio_params, batch.patient)
+
+      # compute the score of the neural network and store it in the batch
+
+      batch.attach(network.predict_full(batch.text, batch.bio_params, dictionary))
+
+    except Exception:
+
+      self._rewind()
+      raise
+
+    self._logger.info('Processed {} messages of {} batches'.format(len(batch), len(batches)))
+
+    return batch.split([len(b) for b in batches]) if len(batches) > 1 else batches
+
+
+  def _next_batches(self, timeout):
+    """
+    Get the queued batches to evaluate together.
+    The function waits (up to timeout seconds) for the first batch; then the batches are taken from the
+    queue until the number of messages reaches process_batch_size or no new batch arrives within
+    DT_PROCESS_MAX_WAIT seconds from the first one.
+
+    ---------
+
+    Variables
+      - timeout : float - max waiting time in seconds for the first batch
+
+    Return
+      - list - the batches in the queue order (empty if no batch arrived)
+    """
 
-          text_msg, patient_id, bio_params, time_msg = zip(*data_to_process)
+    target_size = self.config.get('process_batch_size', self.PROCESS_BATCH_SIZE)
 
-          # save radar plot of biological parameters
+    try:
+      batches = [self._queue.get(timeout=timeout)]
 
-          radar_plot(bio_params, patient_id)
+    except Empty:
+      return []
 
-          # compute the score of the neural network
+    deadline = time.monotonic() + DT_PROCESS_MAX_WAIT
+    size = len(batches[0])
 
-          score = network.predict(text_msg, bio_params, dictionary)
+    while size < target_size:
 
-          results_to_write = [(Id, time, s) for s, Id, time in zip(score, patient_id, time_msg)]
+      try:
+        batch = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
 
-          self._score.put(results_to_write)
+      except Empty:
+        break
 
-      except Exception as e:
+      batches.append(batch)
+      size += len(batch)
 
-        self.log_error(e)
+    return batches
 
 
-  @repeat_interval(DT_WRITE_SCORE_MESSAGES)
+  @scheduled(0, mode=FIXED_DELAY, delay=0)
   def callback_write_score_messages(self):
     """
     Callback function.
@@ -230,59 +478,173 @@ class FiloBluDB(object):
     If there are new score variables to write the db is updated following the assumpion of unique keyword
     identifier given by (patient_id, message_time).
     If there are possible mismatch change the query and the previous process callback according to the right variables
+    All the batches available in the queue are written together.
+    After the write the watermark is moved to the key of the last scored message.
 
-    The function is called every DT_WRITE_SCORE_MESSAGES seconds.
+    The function is a fixed-delay job of the scheduler called again as soon as it returns: each call waits
+    (up to DT_WRITE_SCORE_MESSAGES seconds) for new scores, so the scores are written as soon as they are computed.
     """
 
-    if not self._wait:
+    try:
+
+      try:
+        batches = [self._score.get(timeout=DT_WRITE_SCORE_MESSAGES)]
+
+      except Empty:
+        return
+
+      while not self._score.empty():
+        batches.append(self._score.get())
 
       self._logger.info('Calling Callback write message')
 
-      try:
+      self.write_batches(batches)
+
+    except Exception as e:
+
+      self.log_error(e)
+
+
+  def write_batches(self, batches):
+    """
+    Write the scores of a list of batches and move the watermark (see _advance_watermark).
+    If the write fails the read position is rewound (see _rewind), so the messages are read again.
+
+    ---------
+
+    Variables
+      - batches : list - the scored MessageBatch in the read order
+    """
+
+    try:
+      self._write_scores([row for batch in batches for row in batch.score_rows()])
+
+    except Exception:
+
+      self._rewind()
+      raise
+
+    self._advance_watermark(batches)
+
+    for batch in batches:
+      self._logger.info('Score last messages: {}'.format(batch.score.tolist()) )
+      self._logger.info('Topic last messages: {}'.format(batch.topic.tolist()) )
+
+
+  def _advance_watermark(self, batches):
+    """
+    Mark the given batches as written and move the watermark to the last key of the contiguous run of
+    written batches at the head of the read order, so the watermark never moves over a batch which is
+    not written yet (or which failed).
+    The batches which are not tracked (read before a rewind) do not move the watermark.
+
+    ---------
+
+    Variables
+      - batches : list - the written MessageBatch
+    """
+
+    keys = {(batch.first_key, batch.last_key) for batch in batches}
+    watermark = None
+
+    with self._in_flight_lock:
+
+      for entry in self._in_flight:
+        if (entry[1], entry[2]) in keys:
+          entry[3] = True
+
+      while self._in_flight and self._in_flight[0][3]:
+        watermark = self._in_flight.popleft()[2]
+
+    if watermark is not None and (self._watermark is None or watermark > self._watermark):
+      self._save_watermark(watermark)
+
+
+  def _rewind(self):
+    """
+    Move the read position back to the start of the oldest batch which is not written yet, after a failure
+    of the process or write stage.
+    The batches still queued are processed and written again (the write of the scores is idempotent) but
+    they do not move the watermark: the messages after the rewound position are read again by the next
+    read (the scored ones are skipped by the sa_score = 0 condition).
+    """
+
+    with self._in_flight_lock:
+
+      if self._in_flight:
+        self._read_position = self._in_flight[0][0]
+
+      # the batches before the rewound position are written, so their messages are skipped by the read
+      self._read_ties = ()
+      self._in_flight.clear()
+      self._read_generation += 1
+      position = self._read_position
+
+    self._logger.warning('Processing failed: the messages are read again from {}'.format(position))
+
+
+  def _write_scores(self, rows):
+    """
+    Write the scores in the messaggi table.
+    The rows are written in chunks of (at most) write_chunk_size scores: each chunk is inserted in the
+    staging table by a single multi-row INSERT (executemany) and copied in the messaggi table by a single
+    UPDATE ... JOIN, so a chunk costs a fixed number of round-trips.
+    Each chunk is committed in its own transaction and it is retried after a deadlock or a lock wait timeout.
 
-        if not self._score.empty():
+    ---------
+
+    Variables
+      - rows : list - the (id_paziente, scritto_il, sa_score) tuple of each message
+    """
+
+    chunk_size = self.config.get('write_chunk_size', self.WRITE_CHUNK_SIZE)
+
+    with self._pool.connection() as db:
+
+      cursor = db.cursor()
+      cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS {0} (KEY (id_paziente, scritto_il)) \
+                      SELECT id_paziente, scritto_il, sa_score FROM messaggi LIMIT 0'.format(self.STAGING_TABLE))
+
+      for start in range(0, len(rows), chunk_size):
+
+        chunk = rows[start : start + chunk_size]
 
-          score = self._score.get()
+        for retry in range(self.WRITE_RETRIES + 1):
 
-          for id_paziente, scritto_il, sa_score in score:
-            self._cursor.execute('UPDATE messaggi SET sa_score = {0} WHERE id_paziente = {1} AND scritto_il = "{2}"'.format(
-                                  sa_score, id_paziente, scritto_il))
+          try:
 
-          self._db.commit()
+            db.start_transaction()
+            cursor.execute('DELETE FROM {0}'.format(self.STAGING_TABLE))
+            cursor.executemany('INSERT INTO {0} (id_paziente, scritto_il, sa_score) VALUES (%s, %s, %s)'.format(
+                                self.STAGING_TABLE), chunk)
+            cursor.execute('UPDATE messaggi JOIN {0} AS staging \
+                            ON (messaggi.id_paziente = staging.id_paziente AND messaggi.scritto_il = staging.scritto_il) \
+                            SET messaggi.sa_score = staging.sa_score'.format(self.STAGING_TABLE))
+            db.commit()
+            break
 
-          self._logger.info('Score last messages: {}'.format(list(map(operator.itemgetter(2), score))) )
+          except mysql.connector.Error as e:
 
-########## THIS IS THE BEST SOLUTION BUT IT DOES NOT WORK BECAUSE COLUMNS HAVE NOT DEFAULT VALUES!!!
-#          try:
-#            self._cursor.executemany('INSERT INTO messaggi (id_account, id_paziente, scritto_il, sa_score) VALUES (0, %s, %s, %s) ON DUPLICATE KEY UPDATE id_paziente=VALUES(id_paziente), scritto_il=VALUES(scritto_il)',
-#                                     score)
-#            self._db.commit()
-#
-#            self._logger.info(self._cursor.rowcount, 'Record inserted successfully into "messaggi" table')
-#
-#            self._logger.info('Score last messages: {}'.format(list(map(operator.itemgetter(2), score))) )
-#
-#          except mysql.connector.Error as e:
-#
-#            self._db.rollback()
-#            self.log_error('Failed to insert into MySQL table {}'.format(e))
+            db.rollback()
 
-      except Exception as e:
+            if e.errno not in self.RETRY_ERRORS or retry == self.WRITE_RETRIES:
+              raise
 
-        self.log_error(e)
+            self._logger.warning('Write of the scores failed ({}): retry {}/{}'.format(e, retry + 1, self.WRITE_RETRIES))
+            time.sleep(DT_WRITE_RETRY * 2**retry)
 
 
   # check new weights model every day
-  @repeat_interval(DT_LOAD_NEW_WEIGHTS)
+  @scheduled(DT_LOAD_NEW_WEIGHTS, jitter=DT_MAINTENANCE_JITTER)
   def callback_load_new_weights(self, current_weight_file, update_directory):
     """
     Callback function.
     This callback check if there is a new neural network model in the update_directory.
     The updated model must be a file with .upd extension and it must be put in the
     update_directory (just a single file!!).
-    The callback moves the update_file into the older one and set a wait variable to
-    "stop" the other threads execution until the main service does not reload the network
-    model.
+    The callback moves the update_file into the older one and it pauses the read and process
+    jobs (RELOAD_JOBS) until the main service reloads the network model and gives it to set_network.
+    The main service blocked in wait_reload is woken up.
 
     ---------
 
@@ -291,30 +653,47 @@ class FiloBluDB(object):
       - update_directory: string - the directory in which the update_files are located.
     """
 
-    self.logger.info('Calling Callback read new model')
+    self._logger.info('Calling Callback read new model')
 
     try:
 
-      update_files = glob.glob(os.path.join(os.path.abspath(update_directory), '*.upd'))
+      if self.update_weights(current_weight_file, update_directory):
+        self._scheduler.pause(*self._reload_jobs())
+        self._reload_event.set()
 
-      if len(update_files) > 1:
+    except Exception as e:
 
-        self.log_error('Error Callback read new model. Found more than one update file')
+      self.log_error(e)
 
-      else:
 
-        update_files = update_files[0]
-        # move the new file
-        os.rename(update_files, current_weight_file)
+  def update_weights(self, current_weight_file, update_directory):
+    """
+    Move the update file (.upd extension) of the update_directory into the current weight file.
 
-        self._wait = True
+    ---------
 
-    except Exception as e:
+    Variables
+      - current_weight_file: string - the filename of the current weight file loaded by the network
+      - update_directory: string - the directory in which the update_files are located.
 
-      self.log_error(e)
+    Return
+      - bool - True if the weight file was updated (the network model must be reloaded)
+    """
+
+    update_files = glob.glob(os.path.join(os.path.abspath(update_directory), '*.upd'))
+
+    if len(update_files) > 1:
+      raise ValueError('Error Callback read new model. Found more than one update file')
 
+    if not update_files:
+      return False
 
-  @repeat_interval(DT_CLEAR_LOG)
+    # move the new file
+    os.replace(update_files[0], current_weight_file)
+    return True
+
+
+  @scheduled(DT_CLEAR_LOG, jitter=DT_MAINTENANCE_JITTER)
   def callback_clear_log(self):
     """
     Callback function.
@@ -330,21 +709,29 @@ class FiloBluDB(object):
 
     try:
 
-      logging.shutdown()
-      logging.basicConfig(level=logging.DEBUG,
-                          format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                          datefmt='%m-%d %H:%M:%S',
-                          filename=self._logfilename,
-                          filemode='w')
-      self._logger = logging.getLogger()
-      self._logger.addHandler(logging.FileHandler(self._logfilename, 'a'))
+      self.clear_log()
 
     except Exception as e:
 
       self.log_error(e)
 
 
-  @repeat_interval(DT_HISTORY_SCORE)
+  def clear_log(self):
+    """
+    Clear the current log file and restart the logging on the same file.
+    """
+
+    logging.shutdown()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M:%S',
+                        filename=self._logfilename,
+                        filemode='w')
+    self._logger = logging.getLogger()
+    self._logger.addHandler(logging.FileHandler(self._logfilename, 'a'))
+
+
+  @scheduled(DT_HISTORY_SCORE, jitter=DT_MAINTENANCE_JITTER)
   def callback_score_history_log(self, update_directory):
     """
     Callback function.
@@ -358,25 +745,106 @@ class FiloBluDB(object):
 
     try:
 
-      now = datetime.now()
+      self.dump_score_history(update_directory)
+
+    except Exception as e:
+
+      self.log_error(e)
+
 
-      self._cursor.execute('SELECT testo, sa_score, sa_valutazione, sa_medico FROM messaggi WHERE scritto_il < "{0}"'.format(
-                            now))
+  def dump_score_history(self, update_directory):
+    """
+    Dump the score history of the service with the validation values in the FiloBlu_Score_History.csv file.
+
+    ---------
+
+    Variables
+      - update_directory: string - the directory of the output file
+    """
 
-      history_score_filename = os.path.join(update_directory, 'FiloBlu_Score_History.csv')
+    now = datetime.now()
 
-      with open(history_score_filename, 'w', encoding='utf-8') as fp:
+    history_score_filename = os.path.join(update_directory, 'FiloBlu_Score_History.csv')
 
-        fp.write('text_message,nn_predict_score,validation_score,doctor_id\n')
+    with self._pool.connection() as db, open(history_score_filename, 'w', encoding='utf-8') as fp:
 
-        for txt, sa_score, sa_val, sa_doc in cursor.fetchall():
-          txt = txt.replace('\n', '').replace('\r', '')
+      cursor = db.cursor()
+      cursor.execute('SELECT testo, sa_score, sa_valutazione, sa_medico FROM messaggi WHERE scritto_il < "{0}"'.format(
+                      now))
 
-          fp.write(','.join(['"' + txt + '"', str(sa_score), str(sa_val), str(sa_doc)]) + '\n')
+      fp.write('text_message,nn_predict_score,validation_score,doctor_id\n')
 
-    except Exception as e:
+      for txt, sa_score, sa_val, sa_doc in cursor.fetchall():
+        txt = txt.replace('\n', '').replace('\r', '')
 
-      self.log_error(e)
+        fp.write(','.join(['"' + txt + '"', str(sa_score), str(sa_val), str(sa_doc)]) + '\n')
+
+
+  def set_network(self, network):
+    """
+    Give the reloaded network model to the process job and resume the jobs paused by
+    callback_load_new_weights.
+
+    ---------
+
+    Variables
+      - network : object - the neural network object (as tensorflow model or the numpy one)
+    """
+
+    if 'callback_process_messages' in self._scheduler:
+      job = self._scheduler['callback_process_messages']
+      job.args = (network, ) + job.args[1:]
+
+    self._reload_event.clear()
+
+    # a stop during the reload must still wake up the main loop (stop sets the stop event first)
+    if self._stop_event.is_set():
+      self._reload_event.set()
+      return
+
+    self._scheduler.resume(*self._reload_jobs())
+
+
+  def wait_reload(self, timeout=None):
+    """
+    Block the caller (the main loop of the service) until the network model must be reloaded
+    (see callback_load_new_weights) or the service is stopped.
+
+    ---------
+
+    Variables
+      - timeout : float - max waiting time in seconds (None waits forever)
+
+    Return
+      - bool - True if the network model must be reloaded, False if the service is stopped (or the timeout expired)
+    """
+
+    if self._stop_event.is_set():
+      return False
+
+    self._reload_event.wait(timeout)
+    return self.reload_pending
+
+
+  def stop(self, timeout=DT_STOP):
+    """
+    Stop the service: the main loop blocked in wait_reload is woken up and the scheduler is stopped
+    (the running jobs are waited up to timeout seconds).
+
+    ---------
+
+    Variables
+      - timeout : float - max waiting time in seconds for the running jobs
+    """
+
+    self._stop_event.set()
+    self._reload_event.set()
+    self._scheduler.stop(timeout=timeout)
+
+
+  def _reload_jobs(self):
+    # the registered jobs of RELOAD_JOBS
+    return [name for name in self.RELOAD_JOBS if name in self._scheduler]
 
 
   def log_error(self, exception):
@@ -404,6 +872,50 @@ class FiloBluDB(object):
 
 
 
+  @property
+  def scheduler(self):
+    """
+    Class member to obtain the scheduler of the callbacks.
+    Each call of a callback_* function registers it as a job of the scheduler and it returns the Job;
+    the scheduler can be used to pause, resume or stop the jobs and to get their statistics.
+
+    ---------
+
+    Return
+      - Scheduler type - the private scheduler member.
+    """
+    return self._scheduler
+
+
+
+  @property
+  def reload_pending(self):
+    """
+    Class member to check if the network model must be reloaded (see callback_load_new_weights).
+
+    ---------
+
+    Return
+      - bool type - True if the jobs are paused waiting for the new network model (see set_network).
+    """
+    return self._reload_event.is_set() and not self._stop_event.is_set()
+
+
+
+  @property
+  def pool_stats(self):
+    """
+    Class member to obtain the statistics of the db connection pool.
+
+    ---------
+
+    Return
+      - dict type - number of connections (opened, in use, idle), checkouts, waits and reconnections.
+    """
+    return self._pool.stats()
+
+
+
   @property
   def message_ID(self):
     """
@@ -438,8 +950,6 @@ class FiloBluDB(object):
 
 if __name__ == '__main__':
 
-  import time
-
   from misc import read_dictionary
   from network_model_np import NetworkModel
 
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+import os
+import json
+import struct
+import numpy as np
+from collections.abc import Mapping
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# The compiled dictionary file is given by
+#
+#   MAGIC (8 bytes) | version (uint32) | header size (uint32) | json header | padding | tables
+#
+# Each table is a sorted array of fixed-width utf-8 strings (the keys) and the array of the word positions
+# (the values) in the same order.
+# The json header stores the number of entries, the width of the keys and the offsets of the two arrays
+# measured from the beginning of the data section (the first multiple of ALIGNMENT bytes after the header).
+# Two tables are stored: the words of the dictionary and the index of words and variants of the Vocabulary.
+
+MAGIC = b'FILOBLUD'
+VERSION = 1
+ALIGNMENT = 64
+EXTENSION = '.fbd'
+
+TABLES = ('words', 'index')
+
+_PREAMBLE = struct.Struct('<8sII')
+
+
+def _align(size):
+  return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class StringTable(Mapping):
+  """
+  Read-only mapping of words to integer stored as a sorted array of fixed-width strings.
+  The lookup is a binary search (np.searchsorted) over the keys, so the arrays can be memory-mapped
+  and shared between processes without building any Python object.
+
+  --------
+
+  Members
+    - width : int - max number of (utf-8) bytes of the keys
+  """
+
+  def __init__(self, keys, values):
+    """
+    StringTable constructor.
+
+    --------
+
+    Variables
+      - keys : np.array(ndim=1, dtype=bytes) - the sorted utf-8 words
+      - values : np.array(ndim=1, dtype=int) - the value of each word
+    """
+    self._keys = keys
+    self._values = values
+    self.width = keys.dtype.itemsize
+
+  def _find(self, key):
+
+    if not len(self._keys):
+      return -1
+
+    key = key.encode('utf-8')
+
+    if len(key) > self.width:
+      return -1
+
+    i = int(np.searchsorted(self._keys, key))
+    return i if i < len(self._keys) and self._keys[i] == key else -1
+
+  def __getitem__(self, word):
+    i = self._find(word)
+
+    if i == -1:
+      raise KeyError(word)
+
+    return int(self._values[i])
+
+  def __contains__(self, word):
+    return isinstance(word, str) and self._find(word) != -1
+
+  def __iter__(self):
+    return (key.decode('utf-8') for key in self._keys)
+
+  def __len__(self):
+    return len(self._keys)
+
+  def get(self, word, default=None):
+    i = self._find(word)
+    return default if i == -1 else int(self._values[i])
+
+  def get_many(self, words, default=None):
+    """
+    Look up a list of words with a single vectorized binary search.
+
+    --------
+
+    Variables
+      - words : list - the words to look up
+      - default : int - the value of the missing words
+
+    Return
+      - list - the value of each word (default for the missing words)
+    """
+
+    if not words or not len(self._keys):
+      return [default] * len(words)
+
+    encoded = [word.encode('utf-8') for word in words]
+    # the longer keys would be truncated by the fixed-width conversion
+    valid = np.fromiter(map(len, encoded), dtype='i8', count=len(encoded)) <= self.width
+    encoded = np.asarray(encoded, dtype=self._keys.dtype)
+
+    idx = np.minimum(np.searchsorted(self._keys, encoded), len(self._keys) - 1)
+    found = valid & (self._keys[idx] == encoded)
+
+    values = self._values[idx].tolist()
+    return [v if f else default for v, f in zip(values, found.tolist())]
+
+
+def _table(mapping):
+
+  keys = sorted(word.encode('utf-8') for word in mapping)
+  width = max(map(len, keys), default=1)
+
+  keys = np.asarray(keys, dtype='S{:d}'.format(width))
+  values = np.asarray([mapping[key.decode('utf-8')] for key in keys], dtype='i4')
+  return keys, values
+
+
+def is_dictionary_file(filename):
+  """
+  Check if the given file is stored in the compiled dictionary format.
+
+  ---------
+
+  Variables
+    - filename : string - the dictionary filename
+
+  Return
+    - bool - True if the file starts with the format magic number
+  """
+  with open(filename, 'rb') as fp:
+    return fp.read(len(MAGIC)) == MAGIC
+
+
+def compiled_filename(dict_file):
+  """
+  Get the filename of the compiled version of a text dictionary (same name with the .fbd extension).
+  """
+  return os.path.splitext(dict_file)[0] + EXTENSION
+
+
+def save_dictionary(words, index, filename):
+  """
+  Write the dictionary in the compiled format.
+  The file is written aside and moved on the given filename, so the tables memory-mapped from the previous
+  version of the file are not changed.
+
+  ---------
+
+  Variables
+    - words : dict - the dictionary of words in which keys are words and values are integer (freq order)
+    - index : dict - the index of words and variants (see misc.Vocabulary)
+    - filename : string - the output filename
+  """
+
+  tables = {name : _table(mapping) for name, mapping in zip(TABLES, (words, index))}
+
+  entries = []
+  arrays = []
+  offset = 0
+  for name in TABLES:
+    keys, values = tables[name]
+    entries.append({'table' : name,
+                    'size' : len(keys),
+                    'width' : keys.dtype.itemsize,
+                    'keys' : offset,
+                    'values' : _align(offset + keys.nbytes)
+                    })
+    arrays.extend(((entries[-1]['keys'], keys), (entries[-1]['values'], values)))
+    offset = _align(entries[-1]['values'] + values.nbytes)
+
+  header = json.dumps({'version' : VERSION, 'alignment' : ALIGNMENT, 'tables' : entries}).encode('utf-8')
+  data_start = _align(_PREAMBLE.size + len(header))
+
+  tmp_filename = filename + '.tmp'
+
+  with open(tmp_filename, 'wb') as fp:
+    fp.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)))
+    fp.write(header)
+
+    for arr_offset, arr in arrays:
+      fp.write(b'\0' * (data_start + arr_offset - fp.tell()))
+      fp.write(arr.tobytes())
+
+  os.replace(tmp_filename, filename)
+
+
+def read_header(filename):
+  """
+  Read the json header of a compiled dictionary file.
+
+  ---------
+
+  Variables
+    - filename : string - the dictionary filename
+
+  Return
+    - header : dict - the header with the description of the stored tables and the start of the data section
+  """
+
+  with open(filename, 'rb') as fp:
+    magic, version, header_size = _PREAMBLE.unpack(fp.read(_PREAMBLE.size))
+
+    if magic != MAGIC:
+      raise ValueError('The file {} is not a FiloBlu dictionary file'.format(filename))
+
+    if version > VERSION:
+      raise ValueError('Unsupported dictionary file version {} (max supported {})'.format(version, VERSION))
+
+    header = json.loads(fp.read(header_size).decode('utf-8'))
+
+  header['data_start'] = _align(_PREAMBLE.size + header_size)
+  return header
+
+
+def load_dictionary(filename):
+  """
+  Load the compiled dictionary as read-only memory-mapped tables.
+  The data are not copied: the tables share the OS page-cache pages of the file, so different processes
+  which load the same file share the same physical memory.
+
+  ---------
+
+  Variables
+    - filename : string - the dictionary filename
+
+  Return
+    - words : StringTable - the dictionary of words
+    - index : StringTable - the index of words and variants
+  """
+
+  header = read_header(filename)
+  start = header['data_start']
+
+  tables = {}
+  for entry in header['tables']:
+
+    if entry['size']:
+      keys = np.memmap(filename, mode='r', dtype='S{:d}'.format(entry['width']),
+                       offset=start + entry['keys'], shape=(entry['size'], ))
+      values = np.memmap(filename, mode='r', dtype='i4',
+                         offset=start + entry['values'], shape=(entry['size'], ))
+    else:
+      keys = np.empty(shape=(0, ), dtype='S1')
+      values = np.empty(shape=(0, ), dtype='i4')
+
+    tables[entry['table']] = StringTable(keys, values)
+
+  try:
+    return tuple(tables[name] for name in TABLES)
+
+  except KeyError as e:
+    raise ValueError('The dictionary file {} does not contain the table {}'.format(filename, e.args[0]))
+
+
+def convert_dictionary(dict_file, filename):
+  """
+  Convert the text dictionary file in the compiled format.
+
+  ---------
+
+  Variables
+    - dict_file : string - the text dictionary filename (see misc.read_dictionary)
+    - filename : string - the output filename
+  """
+
+  from misc import Vocabulary, read_words
+
+  vocabulary = Vocabulary(read_words(dict_file))
+  save_dictionary(vocabulary, vocabulary.index, filename)
+
+
+def parse_args():
+  """
+  Just a simple parser of the command line.
+
+  -----
+
+  Return
+
+    args : object - Each member of the object identify a different command line argument (properly casted)
+  """
+
+  import argparse
+
+  description = 'Filo Blu dictionary compiler (text -> memory-mapped format)'
+
+  parser = argparse.ArgumentParser(description = description)
+  parser.add_argument('--input',
+                      dest='input',
+                      type=str,
+                      required=True,
+                      action='store',
+                      help='Word dictionary sorted by frequency'
+                      )
+  parser.add_argument('--output',
+                      dest='output',
+                      type=str,
+                      required=False,
+                      action='store',
+                      help='Output dictionary filename (default: input filename with .fbd extension)',
+                      default=None
+                      )
+
+  args = parser.parse_args()
+  args.input = os.path.abspath(args.input)
+  args.output = os.path.abspath(args.output) if args.output else compiled_filename(args.input)
+
+  return args
+
+
+if __name__ == '__main__':
+
+  args = parse_args()
+
+  convert_dictionary(args.input, args.output)
+
+  print('Dictionary compiled: {} -> {}'.format(args.input, args.output))
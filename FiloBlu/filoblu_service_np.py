@@ -8,7 +8,7 @@ import win32event
 import win32service
 import win32serviceutil
 
-from database import FiloBluDB
+from database import FiloBluDB, DT_STOP
 
 __author__ = 'Nico Curti'
 __email__ = 'nico.curti2@unibo.it'
@@ -62,11 +62,15 @@ class FiloBluService (win32serviceutil.ServiceFramework):
 
     try:
 
-      from network_model_np import NetworkModel
+      from backends import get_backend, backend_from_config
+
+      # Import the backend selected in the config file (numpy by default) only one time!!
+
+      self._NetworkModel = get_backend(backend_from_config(self._db.config))
 
       # Load the network model only one time!!
 
-      self._net = NetworkModel(MODEL)
+      self._net = self._NetworkModel(MODEL)
       self._db.get_logger.info('MODEL LOADED')
 
     except Exception as e:
@@ -101,10 +105,12 @@ class FiloBluService (win32serviceutil.ServiceFramework):
     There are no other alternatives up to now.
     """
 
-    # tell the SCM we're shutting down
-    self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
+    # tell the SCM we're shutting down (the running jobs are waited up to DT_STOP seconds)
+    self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING, waitHint=DT_STOP * 1000)
     # fire the stop event
     win32event.SetEvent(self.hWaitStop)
+    # wake up the main loop and stop the scheduler of the callbacks
+    self._db.stop(timeout=DT_STOP)
     exit(0)
 
 
@@ -115,25 +121,46 @@ class FiloBluService (win32serviceutil.ServiceFramework):
     after the installation of the service (python filoblu_service.py install).
     Do not try to call this function explicitly because it is automatically run after the 'start'.
 
-    Before the main loop of the service (while rc != win32event.WAIT_OBJECT_0) a series of timer-function
+    Before the main loop of the service (while self._db.wait_reload()) a series of timer-function
     are called.
-    The function are public members of the FiloBluDB member object and are all decorated with a time_interval
-    function (see misc.py for the decorators implementation).
-    This function spawns a thread for each one and the functions are asynchronously called at each time interval
-    set in the function definition (see database.py for the functions implementation).
+    The main loop sleeps until the 'callback_load_new_weights' finds new weights (the network model is
+    reloaded) or the service is stopped (SvcStop).
+    The function are public members of the FiloBluDB member object and are all decorated with the scheduled
+    function (see scheduler.py for the decorator implementation).
+    Each call registers the function as a job of the FiloBluDB scheduler and the functions are asynchronously
+    called at each time interval set in the function definition (see database.py for the functions implementation).
 
     The 'callback_read_last_messages' make a query to the central db and it processes the last messages found in
     the time interval.
     The read data are then processed by the neural network framework in the 'callback_process_messages' function;
     finaaly the scores are written in the db by the 'callback_write_score_messages'.
-    The time interval of this function must be set according to the execution time of the processing step and
-    to the application needs.
+    These two functions wait on the queues filled by the previous stage, so the messages are processed and
+    written as soon as they are read.
 
     The 'callback_load_new_weights' looks for an update-model-file in a hard coded directory.
     The 'callback_clear_log' clear the log file to a better memory management.
     This second callback must be called with a larger time interval (example each day).
+
+    With the "runtime" : "asyncio" config key the same stages run in an AsyncRuntime event loop (see
+    async_runtime.py) in a separated thread, which is stopped by the stop event.
     """
 
+    # the asyncio runtime is used if it is set in the config file ("runtime" : "asyncio")
+    if self._db.config.get('runtime', 'threads') == 'asyncio':
+
+      from threading import Thread
+      from async_runtime import AsyncRuntime
+
+      runtime = AsyncRuntime(self._db, self._net, self._dict, MODEL, UPDATE_DIR, self._NetworkModel)
+      worker = Thread(target=runtime.run_forever)
+      worker.start()
+
+      win32event.WaitForSingleObject(self.hWaitStop, win32event.INFINITE)
+
+      runtime.stop()
+      worker.join()
+      return
+
     self._db.callback_read_last_messages()
     time.sleep(.5)
     self._db.callback_process_messages(self._net, self._dict)
@@ -146,17 +173,10 @@ class FiloBluService (win32serviceutil.ServiceFramework):
 
     self._db.get_logger.info('FILO BLU Service: STARTING UP')
 
-    rc = None
-    # if the stop event hasn't been fired keep looping
-    while rc != win32event.WAIT_OBJECT_0:
-
-      from network_model_np import NetworkModel
-
-      if self._db._wait:
-        self._net = NetworkModel(MODEL)
-        self._db._wait = False
-
-      rc = win32event.WaitForSingleObject(self.hWaitStop, 10)
+    # the main thread sleeps until the network model must be reloaded or the service is stopped
+    while self._db.wait_reload():
+      self._net = self._NetworkModel(MODEL)
+      self._db.set_network(self._net)
 
     self._db.get_logger.info('FILO BLU Service: SHUTDOWN')
 
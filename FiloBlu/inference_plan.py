@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+import numpy as np
+from collections import OrderedDict, defaultdict
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+class Workspace(object):
+  """
+  Container of the temporary buffers of an inference plan.
+  The buffers are identified by a key and they are re-allocated only when a larger size is required,
+  so after the first batches the same memory is re-used by all the calls.
+  """
+
+  def __init__(self):
+    self._buffers = {}
+
+  def get(self, key, shape, dtype):
+    """
+    Get a buffer of (at least) the given shape and dtype.
+
+    ---------
+
+    Variables
+      - key : string - the buffer identifier
+      - shape : tuple - the required shape (only the first dimension can grow)
+      - dtype : type - the data type of the buffer
+
+    Return
+      - np.array - a view of the buffer with the required shape
+    """
+
+    buffer = self._buffers.get(key)
+
+    if buffer is None or buffer.dtype != dtype or buffer.shape[1:] != tuple(shape[1:]) or len(buffer) < shape[0]:
+      rows = shape[0] if buffer is None else max(shape[0], 2 * len(buffer))
+      buffer = np.empty(shape=(rows, ) + tuple(shape[1:]), dtype=dtype)
+      self._buffers[key] = buffer
+
+    return buffer[:shape[0]]
+
+  def tile(self, key, array, rows):
+    """
+    Get a matrix with the given array repeated on each row.
+    The matrix is built only at the first call (or when more rows are required) and re-used by the
+    next ones.
+
+    ---------
+
+    Variables
+      - key : string - the buffer identifier
+      - array : np.array(ndim=1) - the array to repeat
+      - rows : int - the number of rows
+
+    Return
+      - np.array - a (rows, array.size) matrix
+    """
+
+    buffer = self._buffers.get(key)
+
+    if buffer is None or len(buffer) < rows or buffer.shape[1:] != array.shape or buffer.dtype != array.dtype:
+      buffer = np.tile(array, (max(rows, 1), 1))
+      self._buffers[key] = buffer
+
+    return buffer[:rows]
+
+
+class InferencePlan(object):
+  """
+  Execution plan of a network architecture.
+
+  The architecture is given as a sequence of nodes (dict) sorted in topological order.
+  Each node has a 'name', a 'type' and the names of its 'inputs':
+
+    - Input : input data of the network (fed at each run). The data can be a dense matrix or the
+              (indices, offsets) sparse encoding of misc.sparse_sequence.
+    - Dense : linear layer (the layer object with the weights must be given in the layers argument)
+    - Concatenate : concatenation along the features of the inputs
+    - Activation : activation function ('function' key) among linear, relu, sigmoid and softmax
+
+  The output buffer of each node is allocated once with BATCH_SIZE rows and all the operations write
+  in-place on these buffers (out= argument), so the steady-state evaluation of a batch does not allocate
+  new arrays.
+  The activations are evaluated in-place on the buffer of their input when it is not needed by other nodes.
+
+  The Dense nodes which share the same (non Input) source are fused in a single layer: their weights are
+  concatenated along the outputs, so a single matrix product evaluates all of them (ex. the dual heads of
+  the network) and each node uses its own columns of the fused buffer.
+  """
+
+  ACTIVATIONS = ('linear', 'relu', 'sigmoid', 'softmax')
+
+  def __init__(self, architecture, outputs, layers, batch_size, dtype=float):
+    """
+    InferencePlan constructor.
+
+    ---------
+
+    Variables
+      - architecture : list - the sequence of nodes of the network in topological order
+      - outputs : list - the names of the output nodes
+      - layers : dict - the layer objects of the Input, Dense and Concatenate nodes
+      - batch_size : int - max number of rows processed by a single run
+      - dtype : type - data type of the buffers
+    """
+
+    self._batch_size = batch_size
+    self._dtype = np.dtype(dtype)
+    self._layers = layers
+
+    self._nodes = OrderedDict()
+    consumers = defaultdict(int)
+
+    for node in architecture:
+
+      name = node['name']
+
+      if name in self._nodes:
+        raise ValueError('Duplicated node {} in the architecture'.format(name))
+
+      inputs = node.get('inputs', ())
+      inputs = (inputs, ) if isinstance(inputs, str) else tuple(inputs)
+
+      for source in inputs:
+        if source not in self._nodes:
+          raise ValueError('Node {} uses the undefined input {}'.format(name, source))
+        consumers[source] += 1
+
+      self._nodes[name] = dict(node, inputs=inputs)
+
+    for name in outputs:
+      if name not in self._nodes:
+        raise ValueError('Undefined output node {}'.format(name))
+
+    self._outputs = tuple(outputs)
+    self._inputs = tuple(name for name, node in self._nodes.items() if node['type'] == 'Input')
+
+    self._workspace = Workspace()
+    self._scratch = np.empty(shape=(batch_size, ), dtype=self._dtype)
+
+    self._units = {}
+    self._values = {}
+    self._steps = []
+    self._fused = self._fuse_siblings()
+
+    for name, node in self._nodes.items():
+
+      compile_node = getattr(self, '_compile_{}'.format(node['type'].lower()), None)
+
+      if compile_node is None:
+        raise ValueError('Unknown node type {} in node {}'.format(node['type'], name))
+
+      step = compile_node(name, node, consumers)
+
+      if step is not None:
+        self._steps.append(step)
+
+  def _allocate(self, name, units):
+    self._units[name] = units
+    self._values[name] = np.empty(shape=(self._batch_size, units), dtype=self._dtype)
+    return self._values[name]
+
+  def _compile_input(self, name, node, consumers):
+    self._units[name] = self._layers[name].outputs
+    self._values[name] = None
+    return None
+
+  def _fuse_siblings(self):
+    """
+    Find the groups of Dense nodes with the same (non Input) source.
+
+    Return
+      - dict - the list of nodes of each group given by the name of its first node
+    """
+
+    siblings = OrderedDict()
+
+    for name, node in self._nodes.items():
+      if node['type'] != 'Dense':
+        continue
+
+      source, = node['inputs']
+      if self._nodes[source]['type'] != 'Input':
+        siblings.setdefault(source, []).append(name)
+
+    return {group[0] : group for group in siblings.values()
+            if len(group) > 1 and len(set(type(self._layers[name]) for name in group)) == 1}
+
+  def _compile_dense(self, name, node, consumers):
+
+    if name in self._fused:
+      return self._compile_fused_dense(name, node, consumers)
+
+    if any(name in group for group in self._fused.values()):
+      # already evaluated by the fused layer of its group
+      return None
+
+    layer = self._layers[name]
+    source, = node['inputs']
+
+    if layer.shape[0] != self._units[source]:
+      raise ValueError('Inconsistent size of the input of layer {}'.format(name))
+
+    out = self._allocate(name, layer.outputs)
+    workspace = self._workspace
+    values = self._values
+
+    def step(num_rows):
+      data = values[source]
+
+      if isinstance(data, tuple):
+        layer.predict_sparse_into(data[0], data[1], out[:num_rows], workspace)
+      else:
+        layer.predict_into(data[:num_rows], out[:num_rows], workspace)
+
+    return step
+
+  def _compile_fused_dense(self, name, node, consumers):
+
+    group = self._fused[name]
+    fused_name = '+'.join(group)
+    layer = self._layers[name].fuse([self._layers[member] for member in group], name=fused_name)
+    source, = node['inputs']
+
+    if layer.shape[0] != self._units[source]:
+      raise ValueError('Inconsistent size of the input of layer {}'.format(name))
+
+    out = self._allocate(fused_name, layer.outputs)
+    workspace = self._workspace
+    values = self._values
+
+    start = 0
+    for member in group:
+      units = self._layers[member].outputs
+      self._units[member] = units
+      self._values[member] = out[:, start : start + units]
+      start += units
+
+    def step(num_rows):
+      layer.predict_into(values[source][:num_rows], out[:num_rows], workspace)
+
+    return step
+
+  def _compile_concatenate(self, name, node, consumers):
+
+    sources = node['inputs']
+    out = self._allocate(name, sum(self._units[source] for source in sources))
+    values = self._values
+
+    slices = []
+    start = 0
+    for source in sources:
+      slices.append((source, slice(start, start + self._units[source])))
+      start += self._units[source]
+
+    def step(num_rows):
+      for source, columns in slices:
+        np.copyto(out[:num_rows, columns], values[source][:num_rows])
+
+    return step
+
+  def _compile_activation(self, name, node, consumers):
+
+    source, = node['inputs']
+    function = node.get('function', 'linear')
+
+    if function not in self.ACTIVATIONS:
+      raise ValueError('Unknown activation function {} in node {}'.format(function, name))
+
+    inplace = consumers[source] == 1 and self._nodes[source]['type'] != 'Input' and source not in self._outputs
+
+    if inplace:
+      self._units[name] = self._units[source]
+      self._values[name] = out = self._values[source]
+    else:
+      out = self._allocate(name, self._units[source])
+
+    kernel = getattr(self, '_{}'.format(function))
+    values = self._values
+
+    def step(num_rows):
+      if not inplace:
+        np.copyto(out[:num_rows], values[source][:num_rows])
+      kernel(out[:num_rows])
+
+    return step
+
+  def _linear(self, x):
+    pass
+
+  def _relu(self, x):
+    np.maximum(x, 0., out=x)
+
+  def _sigmoid(self, x):
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    np.add(x, 1., out=x)
+    np.reciprocal(x, out=x)
+
+  def _softmax(self, x):
+    # the operations are evaluated column by column since the broadcasting (and the element-wise
+    # functions on the column views of the fused layers) would use a temporary buffer
+    s = self._scratch[:len(x)]
+    np.maximum.reduce(x, axis=-1, out=s)
+
+    for j in range(x.shape[1]):
+      np.subtract(x[:, j], s, out=x[:, j])
+      np.exp(x[:, j], out=x[:, j])
+
+    np.add.reduce(x, axis=-1, out=s)
+    np.reciprocal(s, out=s)
+
+    for j in range(x.shape[1]):
+      np.multiply(x[:, j], s, out=x[:, j])
+
+  def run(self, feeds):
+    """
+    Evaluate the plan on a batch of data.
+
+    ---------
+
+    Variables
+      - feeds : dict - the data of each Input node (dense matrix or (indices, offsets) sparse encoding)
+
+    Return
+      - tuple - the values of the output nodes. The arrays are views of the plan buffers and they are
+                overwritten by the next run.
+    """
+
+    num_rows = 0
+
+    for name in self._inputs:
+      data = feeds[name]
+      rows = data[1].size - 1 if isinstance(data, tuple) else len(data)
+
+      if num_rows and rows != num_rows:
+        raise ValueError('Inconsistent number of rows in the input {}'.format(name))
+
+      num_rows = rows
+      self._values[name] = data
+
+    if num_rows > self._batch_size:
+      raise ValueError('The batch size ({}) exceeds the plan one ({})'.format(num_rows, self._batch_size))
+
+    for step in self._steps:
+      step(num_rows)
+
+    return tuple(self._values[name][:num_rows] for name in self._outputs)
+
+  @property
+  def inputs(self):
+    return self._inputs
+
+  @property
+  def outputs(self):
+    return tuple((name, self._units[name]) for name in self._outputs)
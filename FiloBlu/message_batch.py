@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+class MessageBatch(object):
+  """
+  Batch of messages exchanged by the stages of the service (read, process and write of the scores).
+  The messages are stored as columns (struct of arrays): the patient ids, the times and the scores are
+  NumPy arrays, the texts and the biological parameters are lists.
+  The scores are attached to the same object by the process stage.
+
+  --------
+
+  Members
+    - text : list - the text of each message
+    - patient : np.array(ndim=1) - the patient id of each message (id_paziente)
+    - time : np.array(ndim=1, dtype=datetime64) - the time of each message (scritto_il)
+    - bio_params : list - the biological parameters of the patient of each message (None if missing)
+    - score : np.array(ndim=1, dtype=float) - priority score of each message (None until the process stage)
+    - topic : np.array(ndim=1, dtype=int) - topic class of each message (None until the process stage)
+    - score_proba : np.array(ndim=2, dtype=float) - probability of each priority class
+    - topic_proba : np.array(ndim=2, dtype=float) - probability of each topic class
+  """
+
+  __slots__ = ('text', 'patient', 'time', 'bio_params', 'score', 'topic', 'score_proba', 'topic_proba')
+
+  def __init__(self, text, patient, time, bio_params):
+    """
+    MessageBatch constructor.
+
+    --------
+
+    Variables
+      - text : list - the text of each message
+      - patient : list - the patient id of each message
+      - time : list - the time (datetime) of each message
+      - bio_params : list - the biological parameters of the patient of each message
+    """
+    self.text = text
+    self.patient = np.asarray(patient)
+    self.time = np.asarray(time, dtype='datetime64[us]')
+    self.bio_params = bio_params
+
+    self.score = None
+    self.topic = None
+    self.score_proba = None
+    self.topic_proba = None
+
+  def __len__(self):
+    return len(self.text)
+
+  def attach(self, prediction):
+    """
+    Store the outputs of the network (misc.Prediction) in the batch.
+    """
+    if len(prediction) != len(self):
+      raise ValueError('Wrong number of predictions. Given {}, expected {}'.format(len(prediction), len(self)))
+
+    self.score = prediction.priority
+    self.topic = prediction.topic
+    self.score_proba = prediction.priority_proba
+    self.topic_proba = prediction.topic_proba
+
+  def score_rows(self):
+    """
+    Get the (id_paziente, scritto_il, sa_score) rows to write in the db (as Python objects).
+    """
+    return list(zip(self.patient.tolist(), self.time.tolist(), self.score.tolist()))
+
+  @classmethod
+  def concatenate(cls, batches):
+    """
+    Merge a list of batches in a single batch (the scores are not merged).
+
+    --------
+
+    Variables
+      - batches : list - the batches to merge
+
+    Return
+      - MessageBatch - the messages of all the batches in the list order
+    """
+    batch = cls.__new__(cls)
+    batch.text = [text for b in batches for text in b.text]
+    batch.patient = np.concatenate([b.patient for b in batches])
+    batch.time = np.concatenate([b.time for b in batches])
+    batch.bio_params = [params for b in batches for params in b.bio_params]
+
+    batch.score = None
+    batch.topic = None
+    batch.score_proba = None
+    batch.topic_proba = None
+
+    return batch
+
+  def split(self, sizes):
+    """
+    Split the batch (with its scores) in consecutive batches of the given sizes.
+    The arrays of the new batches are views of the arrays of the current one.
+
+    --------
+
+    Variables
+      - sizes : list - the number of messages of each batch (the sum must be equal to len(self))
+
+    Return
+      - list - the batches
+    """
+    if sum(sizes) != len(self):
+      raise ValueError('The sizes do not match the number of messages. Given {}, expected {}'.format(sum(sizes), len(self)))
+
+    batches = []
+    start = 0
+
+    for size in sizes:
+      stop = start + size
+      batch = MessageBatch.__new__(MessageBatch)
+
+      for member in self.__slots__:
+        value = getattr(self, member)
+        setattr(batch, member, None if value is None else value[start : stop])
+
+      batches.append(batch)
+      start = stop
+
+    return batches
+
+  @property
+  def first_key(self):
+    """
+    The (scritto_il, id_paziente) key of the first message (the messages are read in the key order).
+    """
+    return (self.time[0].tolist(), self.patient[0].item())
+
+  @property
+  def last_key(self):
+    """
+    The (scritto_il, id_paziente) key of the last message (the messages are read in the key order).
+    """
+    return (self.time[-1].tolist(), self.patient[-1].item())
+
+
+class MessageBatchAssembler(object):
+  """
+  Join of the messages with the biological parameters of their patients.
+  The rows of the messages are consumed directly from the db cursor (no fetchall) and each message is
+  matched with the parameters of its patient by a single dict lookup (hash join), so the cost is
+  O(messages + patients).
+
+  --------
+
+  Members
+    - bio_params : callable - function which returns the biological parameters (dict patient -> params)
+                              of the given set of patients (ex. BiologicalCache.get)
+  """
+
+  def __init__(self, bio_params=None):
+    """
+    MessageBatchAssembler constructor.
+
+    --------
+
+    Variables
+      - bio_params : callable - function which returns the biological parameters (dict patient -> params)
+                                of the given set of patients. It is required only by assemble.
+    """
+    self.bio_params = bio_params
+
+  @staticmethod
+  def join(rows, bio_params):
+    """
+    Lazily join the messages with the biological parameters.
+
+    --------
+
+    Variables
+      - rows : iterable - the (id_paziente, testo, scritto_il) rows of the messages (ex. a db cursor)
+      - bio_params : dict - the biological parameters of each patient
+
+    Return
+      - generator - the (text, patient_id, biological params, time) tuple of each message
+                    (the biological params are None for the patients without parameters)
+    """
+    lookup = bio_params.get
+    return ((text, patient, lookup(patient), time) for patient, text, time in rows)
+
+  def assemble(self, rows):
+    """
+    Read the messages and join them with the biological parameters of their patients.
+    The rows are consumed before the request of the biological parameters, so the same db connection
+    can be used for both the queries.
+
+    --------
+
+    Variables
+      - rows : iterable - the (id_paziente, testo, scritto_il) rows of the messages (ex. a db cursor)
+
+    Return
+      - MessageBatch - the messages in the rows order
+    """
+    patient, text, time = [], [], []
+
+    for patient_msg, text_msg, time_msg in rows:
+      patient.append(patient_msg)
+      text.append(text_msg)
+      time.append(time_msg)
+
+    bio_params = self.bio_params(set(patient)) if patient else {}
+    lookup = bio_params.get
+
+    return MessageBatch(text, patient, time, [lookup(p) for p in patient])
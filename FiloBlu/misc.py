@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import re
 import string
 import threading
 import unicodedata
 import numpy as np
 from functools import wraps
+from itertools import islice
+from collections import OrderedDict
+from collections.abc import Mapping
+
+from dictionary_format import compiled_filename, is_dictionary_file, load_dictionary
 
 __author__ = 'Nico Curti'
 __email__ = 'nico.curti2@unibo.it'
@@ -35,6 +41,162 @@ def add_method(cls):
 
   return decorator
 
+class Prediction(object):
+  """
+  Structured result of the network models.
+  It stores both the outputs of the dual-head network evaluated on a list of messages.
+
+  --------
+
+  Members
+    - priority : np.array(ndim=1, dtype=float) - priority class of each message (1 - less attention, 4 - more attention)
+    - topic : np.array(ndim=1, dtype=int) - topic class of each message (in [1, 3])
+    - priority_proba : np.array(ndim=2, dtype=float) - probability of each priority class
+    - topic_proba : np.array(ndim=2, dtype=float) - probability of each topic class
+  """
+
+  __slots__ = ('priority', 'topic', 'priority_proba', 'topic_proba')
+
+  def __init__(self, y_type, y_pred):
+    """
+    Prediction constructor.
+
+    --------
+
+    Variables
+      - y_type : np.array(ndim=2, dtype=float) - topics probabilities given by the network
+      - y_pred : np.array(ndim=2, dtype=float) - priority probabilities given by the network
+    """
+    self.topic_proba = y_type
+    self.priority_proba = y_pred
+    self.topic = np.argmax(y_type, axis=1) + 1
+    self.priority = (np.argmax(y_pred, axis=1) + 1).astype(float) # class assignment 1 - less attention
+
+  def __len__(self):
+    return len(self.priority)
+
+  def __iter__(self):
+    """
+    Iterate over the messages as (priority, topic, priority_proba, topic_proba) tuples.
+    """
+    return zip(map(float, self.priority), map(int, self.topic), self.priority_proba, self.topic_proba)
+
+
+class PredictionCache(object):
+  """
+  Bounded LRU cache of the network outputs.
+  The entries are addressed by the content of the message, i.e. the sorted and unique word positions
+  given by sparse_sequence: since the network input is a binary bag of words, two messages with the same
+  key have exactly the same outputs.
+  The least recently used entry is discarded when the cache is full.
+
+  --------
+
+  Members
+    - maxsize : int - max number of entries
+    - hits : int - number of messages found in the cache
+    - misses : int - number of messages not found in the cache
+  """
+
+  def __init__(self, maxsize):
+    """
+    PredictionCache constructor.
+
+    --------
+
+    Variables
+      - maxsize : int - max number of entries
+    """
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def key(words):
+    """
+    Get the cache key of a message.
+
+    --------
+
+    Variables
+      - words : np.array(ndim=1, dtype=int) - the sorted and unique word positions of the message
+
+    Return
+      - bytes - the key of the message
+    """
+    return np.ascontiguousarray(words, dtype='i4').tobytes()
+
+  def get(self, key, count=1):
+    """
+    Get the outputs stored with the given key.
+
+    --------
+
+    Variables
+      - key : bytes - the message key
+      - count : int - number of messages with the same key (used by the hits/misses counters)
+
+    Return
+      - tuple - the stored outputs (None if the key is not in the cache)
+    """
+    with self._lock:
+      value = self._entries.get(key)
+
+      if value is None:
+        self.misses += count
+      else:
+        self.hits += count
+        self._entries.move_to_end(key)
+
+      return value
+
+  def put(self, key, value):
+    """
+    Store the outputs of a message.
+
+    --------
+
+    Variables
+      - key : bytes - the message key
+      - value : tuple - the outputs of the message
+    """
+    if self.maxsize <= 0:
+      return
+
+    with self._lock:
+      self._entries[key] = value
+      self._entries.move_to_end(key)
+
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    """
+    Remove all the entries and reset the counters.
+    """
+    with self._lock:
+      self._entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def info(self):
+    """
+    Get the statistics of the cache.
+
+    --------
+
+    Return
+      - dict - hits, misses, current and max number of entries
+    """
+    with self._lock:
+      return {'hits' : self.hits, 'misses' : self.misses, 'size' : len(self._entries), 'maxsize' : self.maxsize}
+
+  def __len__(self):
+    return len(self._entries)
+
+
 def repeat_interval(interval_seconds):
   """
   This function create a very useful decorator to asynchronously run the decorated function at each
@@ -65,9 +227,157 @@ def repeat_interval(interval_seconds):
 
   return decorator
 
-def read_dictionary(dict_file):
+class Vocabulary(Mapping):
   """
-  Read dictionary of words from file.
+  Dictionary of words used for the pre-processing of the messages.
+  It behaves as the (read-only) dict of words and it adds the lookup of the word positions with the same
+  rules of preprocess, i.e. the word itself or, if missing, the word without its last letter (plural and
+  gender endings), 0 otherwise.
+
+  The index of the words also stores the variants of each word with an additional ending vowel, so the
+  most common fallbacks cost a single lookup.
+  The other missing words are resolved once and stored in a bounded cache (OOV_CACHE_SIZE words).
+
+  --------
+
+  Members
+    - words : int - number of words looked up
+    - oov : int - number of words outside the dictionary (position 0)
+  """
+
+  ENDINGS = 'aeiou' # endings of the precomputed variants
+  OOV_CACHE_SIZE = 65536 # max number of missing words stored
+
+  def __init__(self, words, index=None):
+    """
+    Vocabulary constructor.
+
+    --------
+
+    Variables
+      - words : dict - the dictionary of words in which keys are words and values are integer (freq order)
+      - index : dict - optional precomputed index of words and variants (built from words if None)
+    """
+    self._words = words
+    self._index = self._build_index(words) if index is None else index
+    self._missing = {}
+    self._lock = threading.Lock()
+
+    self.words = 0
+    self.oov = 0
+
+  def _build_index(self, words):
+
+    index = {}
+    for word, idx in words.items():
+      for ending in self.ENDINGS:
+        index[word + ending] = idx
+
+    # the words of the dictionary have the precedence on the variants
+    index.update(words)
+    return index
+
+  @property
+  def index(self):
+    """
+    The index of words and variants used by encode.
+    """
+    return self._index
+
+  def __getitem__(self, word):
+    return self._words[word]
+
+  def __contains__(self, word):
+    return word in self._words
+
+  def __iter__(self):
+    return iter(self._words)
+
+  def __len__(self):
+    return len(self._words)
+
+  def get(self, word, default=None):
+    return self._words.get(word, default)
+
+  def _lookup_missing(self, word):
+
+    with self._lock:
+      idx = self._missing.get(word)
+
+      if idx is None:
+        idx = self._words.get(word[:-1], 0)
+
+        if len(self._missing) >= self.OOV_CACHE_SIZE:
+          del self._missing[next(iter(self._missing))]
+
+        self._missing[word] = idx
+
+      return idx
+
+  def encode(self, words):
+    """
+    Get the positions of a list of words.
+
+    --------
+
+    Variables
+      - words : list - the words to look up
+
+    Return
+      - list - the position of each word in the dictionary (0 for the words outside the dictionary)
+    """
+
+    get_many = getattr(self._index, 'get_many', None)
+
+    if get_many is not None: # compiled (memory-mapped) index
+      ids = get_many(words, -1)
+    else:
+      ids = [self._index.get(word, -1) for word in words]
+
+    for i, idx in enumerate(ids):
+      if idx == -1:
+        ids[i] = self._lookup_missing(words[i])
+
+    oov = ids.count(0)
+
+    with self._lock:
+      self.words += len(ids)
+      self.oov += oov
+
+    return ids
+
+  @property
+  def oov_rate(self):
+    """
+    Fraction of the looked up words outside the dictionary.
+    """
+    return self.oov / self.words if self.words else 0.
+
+  def stats(self):
+    """
+    Get the lookup statistics.
+
+    --------
+
+    Return
+      - dict - number of words looked up, number and fraction of the words outside the dictionary and
+               number of missing words stored in the cache
+    """
+    with self._lock:
+      return {'words' : self.words, 'oov' : self.oov, 'oov_rate' : self.oov_rate, 'cached' : len(self._missing)}
+
+  def reset_stats(self):
+    """
+    Reset the lookup counters.
+    """
+    with self._lock:
+      self.words = 0
+      self.oov = 0
+
+
+def read_words(dict_file):
+  """
+  Read the words of the text dictionary file.
   The dictionary file must be sorted by frequency of words in ascending order.
   The file must be formatted as:
 
@@ -75,6 +385,8 @@ def read_dictionary(dict_file):
   word2 freq2
 
   with space as separator
+
+  The words are returned as a dict in which keys are words and values are integer (freq order).
   """
   words = {}
   with open(dict_file, 'r', encoding='utf-8') as fp:
@@ -83,6 +395,30 @@ def read_dictionary(dict_file):
       words[w] = int(i)
   return words
 
+def read_dictionary(dict_file):
+  """
+  Read dictionary of words from file.
+  The file can be a compiled dictionary (see dictionary_format.py) or the text file read by read_words.
+  If a compiled version of the text file (same name with .fbd extension) is found and it is not older
+  than the text file, the compiled one is loaded.
+
+  The compiled tables are memory-mapped, so the loading does not parse the words and the memory is shared
+  between the processes which load the same file.
+
+  The words are returned as a Vocabulary object.
+  """
+
+  if not is_dictionary_file(dict_file):
+    compiled = compiled_filename(dict_file)
+
+    if not os.path.isfile(compiled) or os.path.getmtime(compiled) < os.path.getmtime(dict_file):
+      return Vocabulary(read_words(dict_file))
+
+    dict_file = compiled
+
+  words, index = load_dictionary(dict_file)
+  return Vocabulary(words, index=index)
+
 def preprocess(msg, dictionary):
   """
   Pipeline for text pre-processing.
@@ -130,7 +466,80 @@ def preprocess(msg, dictionary):
   return outvect
 
 
-def vectorize_sequence(seq, dim):
+def _fold(char):
+  # accents removal of a single character (as the NFKD normalization of preprocess)
+  return u''.join([c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c)])
+
+# Translation table of preprocess_batch: punctuation -> space and (latin) accents letters -> "normal" form.
+# The backslash is not included since it is not removed by the regex of preprocess
+# (it escapes the closing bracket of the characters class).
+_PUNCTUATION = string.punctuation.replace('\\', '')
+_TRANSLATE = {ord(c) : u' ' for c in _PUNCTUATION}
+_TRANSLATE.update({i : _fold(chr(i)) for i in range(0x80, 0x250) if _fold(chr(i)) != chr(i)})
+
+
+def preprocess_batch(text_list, dictionary, max_words=None):
+  """
+  Pipeline for text pre-processing of a list of messages (the same of the preprocess function).
+  The punctuations and the accents are replaced by a single str.translate with a precomputed table; the
+  full NFKD normalization is used only for the messages with other non-ascii characters.
+  The positions of the words of all the messages are stored in a single flat array (ragged layout).
+
+  -------------
+
+  Variables
+    text_list: list - the text messages to pre-process
+    dictionary: dict - dictionary of frequency words in which keys are words and values are integer of the freq order
+    max_words: int - the words with position >= max_words are discarded (None keeps all the words)
+
+  Return
+    tokens: np.array(ndim=1, dtype=int) - the position of each word in the dictionary, concatenated
+    offsets: np.array(ndim=1, dtype=int) - the start of each message in tokens (len(text_list) + 1 values)
+  """
+
+  words = []
+  lengths = []
+
+  for msg in text_list:
+
+    # convert to lower, remove punctuation and replace accents
+    msg = msg.lower().translate(_TRANSLATE)
+
+    # str.isascii is not available before Python 3.7
+    try:
+      msg.encode('ascii')
+
+    except UnicodeEncodeError:
+      msg = _fold(msg)
+
+    # split in words
+    msg_words = [i for i in msg.split(' ') if i != '']
+
+    words.extend(msg_words)
+    lengths.append(len(msg_words))
+
+  if isinstance(dictionary, Vocabulary):
+    tokens = dictionary.encode(words)
+
+  else:
+    lookup = dictionary.get
+    tokens = [lookup(word) for word in words]
+    tokens = [lookup(word[:-1], 0) if idx is None else idx for word, idx in zip(words, tokens)]
+
+  tokens = np.asarray(tokens, dtype='i4')
+  rows = np.repeat(np.arange(len(lengths)), lengths)
+
+  if max_words is not None:
+    keep = tokens < max_words
+    tokens = tokens[keep]
+    rows = rows[keep]
+
+  offsets = np.searchsorted(rows, np.arange(len(lengths) + 1)).astype('i8')
+
+  return tokens, offsets
+
+
+def vectorize_sequence(seq, dim, dtype=float):
   """
   Convert matrix of words pre-processed by the preprocess function in a matrix of one-hot encoding of the dictionary
 
@@ -139,12 +548,116 @@ def vectorize_sequence(seq, dim):
   Variables
     seq: np.array(ndim=2, dtype=int) - matrix of the full set of messages pre-processed
     dim: int - dimension of the dictionary file
+    dtype: type - data type of the output matrix
 
   Return
     results: np.array(ndim=2, dtype=float) - one-hot encoding of the messages
   """
 
-  results = np.zeros(shape=(len(seq), dim), dtype=float)
+  results = np.zeros(shape=(len(seq), dim), dtype=dtype)
   for i, s in enumerate(seq):
     results[i, s] = 1.
   return results
+
+
+def sparse_sequence(seq, dim):
+  """
+  Convert matrix of words pre-processed by the preprocess function in a sparse (CSR-like) encoding
+  of the one-hot matrix returned by vectorize_sequence.
+  Only the (unique) positions of the words are stored, so the (len(seq), dim) matrix is never allocated.
+
+  -----------
+
+  Variables
+    seq: np.array(ndim=2, dtype=int) - matrix of the full set of messages pre-processed
+    dim: int - dimension of the dictionary file (words with position >= dim are discarded)
+
+  Return
+    indices: np.array(ndim=1, dtype=int) - the sorted and unique word positions of each message, concatenated
+    offsets: np.array(ndim=1, dtype=int) - the start of each message in indices (len(seq) + 1 values)
+  """
+
+  rows = [np.unique(np.asarray(s, dtype='i4')) for s in seq]
+  rows = [r[r < dim] for r in rows]
+
+  offsets = np.zeros(shape=(len(rows) + 1, ), dtype='i8')
+  np.cumsum([r.size for r in rows], out=offsets[1:])
+
+  indices = np.concatenate(rows) if rows else np.empty(shape=(0, ), dtype='i4')
+  return indices, offsets
+
+
+def batched(iterable, size):
+  """
+  Split an iterable in consecutive chunks of (at most) the given size.
+  The items are consumed lazily, so only one chunk is kept in memory.
+
+  -----------
+
+  Variables
+    iterable: iterable - the sequence of items (ex. a generator or a database cursor)
+    size: int - max number of items of each chunk
+
+  Return
+    generator - the chunks as lists of items
+  """
+
+  iterator = iter(iterable)
+  chunk = list(islice(iterator, size))
+
+  while chunk:
+    yield chunk
+    chunk = list(islice(iterator, size))
+
+
+def predict_stream(predict_full, data, dictionary, batch_size):
+  """
+  Evaluate both the outputs of a network on a stream of messages (shared by the network backends).
+  The messages are consumed and evaluated in chunks of batch_size, so the memory used does not depend
+  on the number of messages.
+
+  -----------
+
+  Variables
+    predict_full: callable - the predict_full function of the network (text_list, bio_params, dictionary)
+    data: iterable - the (text message, biological parameters) pairs
+    dictionary: dict - a dictionary in which keys are words and value are integer (freq order)
+    batch_size: int - max number of messages of each network call
+
+  Return
+    generator - the (priority, topic, priority_proba, topic_proba) of each message in the input order
+  """
+
+  for chunk in batched(data, batch_size):
+    text_list, bio_params = zip(*chunk)
+    yield from predict_full(text_list, bio_params, dictionary)
+
+
+def sparse_batch(tokens, offsets, dim):
+  """
+  Convert the ragged encoding of the messages given by preprocess_batch in the sparse encoding of
+  sparse_sequence (sorted and unique word positions of each message).
+  The conversion is evaluated with a single sort of the whole batch.
+
+  -----------
+
+  Variables
+    tokens: np.array(ndim=1, dtype=int) - the position of each word in the dictionary, concatenated
+    offsets: np.array(ndim=1, dtype=int) - the start of each message in tokens
+    dim: int - dimension of the dictionary file (words with position >= dim are discarded)
+
+  Return
+    indices: np.array(ndim=1, dtype=int) - the sorted and unique word positions of each message, concatenated
+    offsets: np.array(ndim=1, dtype=int) - the start of each message in indices
+  """
+
+  num_rows = offsets.size - 1
+  rows = np.repeat(np.arange(num_rows, dtype='i8'), np.diff(offsets))
+
+  keep = tokens < dim
+  keys = np.unique(rows[keep] * dim + tokens[keep])
+
+  indices = (keys % dim).astype('i4')
+  offsets = np.searchsorted(keys, np.arange(num_rows + 1, dtype='i8') * dim).astype('i8')
+
+  return indices, offsets
@@ -5,7 +5,10 @@ from __future__ import division, print_function
 
 import pickle
 import numpy as np
-from misc import preprocess, vectorize_sequence
+from collections import OrderedDict
+from misc import preprocess_batch, vectorize_sequence, sparse_sequence, sparse_batch, Prediction, PredictionCache, predict_stream
+from inference_plan import InferencePlan, Workspace
+from weights_format import is_weights_file, load_weights, MMAP
 
 __author__ = ['Andrea Ciardiello', 'Stefano Giagu', 'Nico Curti']
 __email__ = ['andrea.ciardiello@gmail.com', 'stefano.giagu@roma1.infn.it', 'nico.curti2@unibo.it']
@@ -43,8 +46,83 @@ class Dense(object):
 
     self._activation = activation
 
+  def _finalize_into(self, out, workspace):
+    # the bias is added as a (rows, outputs) matrix: broadcasting would use a temporary buffer
+    np.add(out, workspace.tile(self._name + '/bias', self._bias, len(out)), out=out)
+
+  def predict_into(self, input_array, out, workspace):
+    """
+    Evaluate the linear part of the layer (without activation) writing the result in the out buffer.
+    The temporary arrays are taken from the workspace (see inference_plan.Workspace).
+    """
+    np.matmul(input_array, self._weights, out=out)
+    self._finalize_into(out, workspace)
+    return out
+
+  def predict_sparse_into(self, indices, offsets, out, workspace):
+    """
+    Evaluate the linear part of the layer (without activation) on a binary bag-of-words input given
+    in the sparse format of misc.sparse_sequence, writing the result in the out buffer.
+    The offsets can be a slice of the full offsets array (they do not need to start from 0).
+    The product between the one-hot matrix and the weights is computed as the sum of the weight rows
+    selected by the word positions of each message.
+    The temporary arrays are taken from the workspace (see inference_plan.Workspace).
+    """
+
+    first, last = offsets[0], offsets[-1]
+    num_indices = last - first
+
+    # messages after the last word are empty: reduceat does not accept their (out of range) start
+    filled = int(np.searchsorted(offsets[:-1], last, side='left'))
+
+    if filled:
+      # np.take works with intp positions: the conversion is done in the workspace to avoid a new array
+      positions = workspace.get('positions', (num_indices, ), np.intp)
+      np.copyto(positions, indices[first : last])
+
+      # the positions are already checked by sparse_sequence: mode='clip' avoids the copy of the output
+      rows = workspace.get('rows', (num_indices, self.outputs), self._weights.dtype)
+      np.take(self._weights, positions, axis=0, out=rows, mode='clip')
+
+      starts = workspace.get('starts', (filled, ), np.intp)
+      np.subtract(offsets[:filled], first, out=starts)
+      np.add.reduceat(rows, starts, axis=0, dtype=out.dtype, out=out[:filled])
+
+      # reduceat gives the row at the start position for the empty messages
+      empty = workspace.get('empty', (filled, ), bool)
+      np.equal(offsets[:filled], offsets[1 : filled + 1], out=empty)
+      if empty.any():
+        out[:filled][empty] = 0.
+
+    out[filled:] = 0.
+
+    self._finalize_into(out, workspace)
+    return out
+
   def predict(self, input_array):
-    return self._activation( ( input_array @ self._weights ) + self._bias )
+    out = np.empty(shape=(len(input_array), self.outputs), dtype=self.dtype)
+    return self._activation( self.predict_into(input_array, out, Workspace()) )
+
+  def predict_sparse(self, indices, offsets):
+    """
+    Evaluate the layer on a binary bag-of-words input given in the sparse format of misc.sparse_sequence.
+    """
+    out = np.empty(shape=(offsets.size - 1, self.outputs), dtype=self.dtype)
+    return self._activation( self.predict_sparse_into(indices, offsets, out, Workspace()) )
+
+  def astype(self, dtype):
+    self._weights = self._weights.astype(dtype, copy=False)
+    self._bias = self._bias.astype(dtype, copy=False)
+    return self
+
+  def fuse(self, layers, name=''):
+    """
+    Build a single layer which evaluates the given layers (with the same input) at the same time.
+    The weights and biases are concatenated along the outputs.
+    """
+    return Dense(sum(layer.outputs for layer in layers), self.shape[0], self._activation, name=name,
+                 weights=np.concatenate([layer._weights for layer in layers], axis=1),
+                 biases=np.concatenate([layer._bias for layer in layers]))
 
   def load(self, params):
     self._weights, self._bias = params
@@ -61,20 +139,89 @@ class Dense(object):
   def shape(self):
     return self._weights.shape
 
+  @property
+  def dtype(self):
+    return self._bias.dtype
+
   @property
   def name(self):
     return '{} (Dense)'.format(self._name)
 
 
+class QuantizedDense(Dense):
+  """
+  Dense layer with int8 weights.
+  The weights are quantized per output column with a symmetric scale (max(|w|) / 127) and the products
+  are accumulated in float32 before the rescaling.
+  """
+
+  def __init__(self, output_shape, input_shape, activation, name='', weights=None, biases=None):
+
+    super(QuantizedDense, self).__init__(output_shape, input_shape, activation, name=name, weights=weights, biases=biases)
+
+    scale = np.abs(self._weights).max(axis=0) / 127.
+    scale[scale == 0.] = 1.
+
+    self._weights = np.round(self._weights / scale).astype('i1')
+    self._scale = scale.astype('f4')
+    self._bias = self._bias.astype('f4')
+
+  def _finalize_into(self, out, workspace):
+    np.multiply(out, workspace.tile(self._name + '/scale', self._scale, len(out)), out=out)
+    super(QuantizedDense, self)._finalize_into(out, workspace)
+
+  def astype(self, dtype):
+    return self
+
+  def fuse(self, layers, name=''):
+    """
+    Build a single quantized layer which evaluates the given layers (with the same input) at the same time.
+    The int8 weights, the per-column scales and the biases are concatenated along the outputs, so the
+    fused layer gives the same results of the single ones.
+    """
+    fused = QuantizedDense.__new__(QuantizedDense)
+    fused._weights = np.concatenate([layer._weights for layer in layers], axis=1)
+    fused._scale = np.concatenate([layer._scale for layer in layers])
+    fused._bias = np.concatenate([layer._bias for layer in layers])
+    fused._name = name
+    fused._activation = self._activation
+    return fused
+
+  @property
+  def size(self):
+    return self._weights.size + self._bias.size + self._scale.size
+
+  @property
+  def name(self):
+    return '{} (QuantizedDense)'.format(self._name)
+
+
 class Concatenate(object):
 
-  def __init__(self, layers, axis=1):
-    self.idx_layer_1, self.idx_layer_2 = layers
+  def __init__(self, layers, outputs, axis=1, name=''):
+    self._layers = tuple(layers)
+    self._outputs = outputs
     self.axis = axis
+    self._name = name
 
   def predict(self, input_array):
-    return np.concatenate()
+    return np.concatenate(input_array, axis=self.axis)
 
+  @property
+  def outputs(self):
+    return self._outputs
+
+  @property
+  def size(self):
+    return 0
+
+  @property
+  def shape(self):
+    return (self._outputs, self._outputs)
+
+  @property
+  def name(self):
+    return '{} (Concatenate)'.format(self._name)
 
 
 class Input(object):
@@ -108,8 +255,58 @@ class NetworkModel(object):
 
   MAX_WORDS = 12000 # max number of words
   BATCH_SIZE = 512 # max number of message to process at the same time
+  CACHE_SIZE = 8192 # max number of messages stored in the prediction cache
+
+  # available precisions of the weights and activations
+  # int8 : weights of the Dense layers on the input words quantized per column, float32 everywhere else
+  PRECISIONS = {'float64' : 'f8', 'float32' : 'f4', 'int8' : 'f4'}
+
+  # NNet Architecture (the same of the Keras model in network_model_tf.py)
+  # The weights file stores the (kernel, bias) of the Dense layers in the same order of the architecture
+  ARCHITECTURE = (
+                  {'name' : 'input_txt', 'type' : 'Input', 'units' : MAX_WORDS},
+                  # dense_1
+                  {'name' : 'dense_1', 'type' : 'Dense', 'units' : 32, 'inputs' : 'input_txt'},
+                  {'name' : 'activation_1', 'type' : 'Activation', 'function' : 'relu', 'inputs' : 'dense_1'},
+                  # dense_2
+                  {'name' : 'dense_2', 'type' : 'Dense', 'units' : 16, 'inputs' : 'activation_1'},
+                  {'name' : 'activation_2', 'type' : 'Activation', 'function' : 'relu', 'inputs' : 'dense_2'},
+                  # dual output
+                  # type output
+                  {'name' : 'out_type', 'type' : 'Dense', 'units' : 3, 'inputs' : 'activation_2'},
+                  {'name' : 'activation_type', 'type' : 'Activation', 'function' : 'softmax', 'inputs' : 'out_type'},
+                  # prediction output
+                  {'name' : 'out_P', 'type' : 'Dense', 'units' : 4, 'inputs' : 'activation_2'},
+                  {'name' : 'activation_P', 'type' : 'Activation', 'function' : 'softmax', 'inputs' : 'out_P'},
+                 )
+  # y_type (topics) and y_pred (priority) outputs
+  OUTPUTS = ('activation_type', 'activation_P')
+
+  def __init__(self, weights_filename=None, sparse=True, precision='float64', cache_size=None, mmap=MMAP):
+    """
+    NetworkModel constructor.
+
+    ---------
+
+    Variables
+      - weights_filename : string - the weights file (weights_format or pickle) of the network
+      - sparse : bool - if True the first layer is evaluated on the sparse encoding of the messages
+                        (misc.sparse_sequence) instead of the dense one-hot matrix (misc.vectorize_sequence)
+      - precision : string - precision of the weights and activations (one of the PRECISIONS keys)
+      - cache_size : int - max number of messages in the prediction cache (CACHE_SIZE if None, 0 disables it)
+      - mmap : bool - if True the weights format file is memory-mapped instead of copied in memory
+                      (the default except on Windows, see weights_format.MMAP)
+    """
+
+    if precision not in self.PRECISIONS:
+      raise ValueError('Unknown precision {}. Available precisions are {}'.format(precision, list(self.PRECISIONS)))
 
-  def __init__(self, weights_filename=None):
+    self.sparse = sparse
+    self.precision = precision
+    self.dtype = np.dtype(self.PRECISIONS[precision])
+    self._weights_filename = weights_filename
+    self._mmap = mmap
+    self._cache = PredictionCache(self.CACHE_SIZE if cache_size is None else cache_size)
 
     if weights_filename:
       model = self._load_weights(weights_filename)
@@ -117,23 +314,30 @@ class NetworkModel(object):
 
   def _load_model(self, model=None):
 
-    net = self._model(model)
-    return net
+    layers = self._model(model)
+    # the cached outputs belong to the previous weights
+    self._cache.clear()
+    self._plan = InferencePlan(self.ARCHITECTURE, self.OUTPUTS, layers, self.BATCH_SIZE, dtype=self.dtype)
+    return list(layers.values())
 
-  def _sigmoid(self, x, derivate=False):
-    sigm = 1. / (1. + np.exp(-x))
-    return sigm * (1. - sigm) if derivate else sigm
-
-  def _softmax(self, x):
-    output = np.exp(x - x.max(axis=-1, keepdims=True))
-    s = 1. / output.sum(axis=-1, keepdims=True)
-    return output * s
-
-  def _relu(self, x):
-    x[x < 0] = 0.
+  def _linear(self, x):
     return x
 
+  @property
+  def _dense_layers(self):
+    return [node['name'] for node in self.ARCHITECTURE if node['type'] == 'Dense']
+
   def _load_weights(self, weights_filename):
+    """
+    Load the weights from the weights format (see weights_format.py) or, as fallback, from the pickle file.
+    The memory-mapped arrays are used without copies if their dtype matches the precision of the model;
+    the update of the service (callback_load_new_weights) replaces the file by os.replace, so the arrays
+    of the running model stay valid.
+    """
+
+    if is_weights_file(weights_filename):
+      return load_weights(weights_filename, layers=self._dense_layers, mmap=self._mmap)
+
     with open(weights_filename, 'rb') as fp:
       model = pickle.load(fp)
 
@@ -141,32 +345,52 @@ class NetworkModel(object):
 
   def _model(self, model=None, seed=123):
     """
-    NNet Architecture
+    Build the layers of the NNet Architecture.
+    The activation functions are evaluated by the inference plan, so the Dense layers are linear.
     """
     np.random.seed(seed)
 
-    if len(model) != 8:
+    if len(model) != 2 * len(self._dense_layers):
       raise ValueError('The model loaded not correspond to the NNet architecture')
 
-    net = []
+    params = dict(zip(self._dense_layers, zip(model[::2], model[1::2])))
+
+    layers = OrderedDict()
+    units = {}
 
-    #net.append( Input(shape=(1, self.MAX_WORDS), name='input_txt') )
+    for node in self.ARCHITECTURE:
 
-    # dense_1
-    net.append( Dense(32, self.MAX_WORDS, self._relu, name='dense_1', weights=model[0], biases=model[1]) )
+      name, kind = node['name'], node['type']
+      inputs = node.get('inputs', ())
+      inputs = (inputs, ) if isinstance(inputs, str) else tuple(inputs)
 
-    # dense_2
-    net.append( Dense(16, net[-1].outputs, self._relu, name='dense_2', weights=model[2], biases=model[3]) )
+      if kind == 'Input':
 
-    # dual output
+        layers[name] = Input(shape=(1, node['units']), name=name)
+        units[name] = node['units']
 
-    # type / prediction output
-    net.append( (
-                  Dense(3, net[-1].outputs, self._softmax, name='out_type', weights=model[4], biases=model[5]),
-                  Dense(4, net[-1].outputs, self._softmax, name='out_type', weights=model[6], biases=model[7])
-                 ) )
+      elif kind == 'Dense':
 
-    return net
+        source, = inputs
+        weights, biases = params[name]
+
+        if self.precision == 'int8' and isinstance(layers.get(source), Input):
+          layers[name] = QuantizedDense(node['units'], units[source], self._linear, name=name, weights=weights, biases=biases)
+        else:
+          layers[name] = Dense(node['units'], units[source], self._linear, name=name, weights=weights, biases=biases).astype(self.dtype)
+
+        units[name] = node['units']
+
+      elif kind == 'Concatenate':
+
+        units[name] = sum(units[source] for source in inputs)
+        layers[name] = Concatenate(inputs, units[name], name=name)
+
+      else:
+
+        units[name] = units[inputs[0]]
+
+    return layers
 
   def summary(self):
 
@@ -197,42 +421,214 @@ class NetworkModel(object):
     return '\n'.join([header, body, tail])
 
 
+  def _allocate_outputs(self, num_messages):
+
+    return tuple(np.empty(shape=(num_messages, units), dtype=self.dtype) for _, units in self._plan.outputs)
+
+
   def _predict(self, input_data):
+    """
+    Evaluate the network on the dense one-hot matrix of the messages.
+    The messages are processed in chunks of BATCH_SIZE rows.
 
-    input_data = [np.expand_dims(i, axis=0) for i in input_data]
-    score = np.empty(shape=(len(input_data), ), dtype='object')
-    for i, data in enumerate(input_data):
-      for layer in self.net:
-        try:
-          res = layer.predict(data)
-        except AttributeError:
-          res = (layer[0].predict(data), layer[1].predict(data))
-        data = res
+    -----------
 
-      score[i] = res
+    Variables
+      input_data: np.array(ndim=2, dtype=float) - one-hot encoding of the messages (misc.vectorize_sequence)
 
-    return score
+    Return
+      y_type: np.array(ndim=2, dtype=float) - topics probabilities
+      y_pred: np.array(ndim=2, dtype=float) - priority probabilities
+    """
 
+    y_type, y_pred = self._allocate_outputs(len(input_data))
 
-  def predict(self, text_list, bio_params, dictionary):#, binning=True):
+    for start in range(0, len(input_data), self.BATCH_SIZE):
+      stop = start + self.BATCH_SIZE
+
+      y_type[start : stop], y_pred[start : stop] = self._plan.run({self._plan.inputs[0] : input_data[start : stop]})
+
+    return y_type, y_pred
+
+
+  def _predict_sparse(self, indices, offsets):
+    """
+    Evaluate the network on the sparse encoding of the messages.
+    The messages are processed in chunks of BATCH_SIZE rows.
+
+    -----------
+
+    Variables
+      indices: np.array(ndim=1, dtype=int) - word positions of the messages (misc.sparse_sequence)
+      offsets: np.array(ndim=1, dtype=int) - start of each message in indices
+
+    Return
+      y_type: np.array(ndim=2, dtype=float) - topics probabilities
+      y_pred: np.array(ndim=2, dtype=float) - priority probabilities
+    """
+
+    num_messages = offsets.size - 1
+    y_type, y_pred = self._allocate_outputs(num_messages)
+
+    for start in range(0, num_messages, self.BATCH_SIZE):
+      stop = min(start + self.BATCH_SIZE, num_messages)
+
+      data = (indices, offsets[start : stop + 1])
+      y_type[start : stop], y_pred[start : stop] = self._plan.run({self._plan.inputs[0] : data})
+
+    return y_type, y_pred
+
+
+  def _evaluate(self, indices, offsets):
+    """
+    Evaluate the network on the sparse encoding of the messages with the evaluation mode of the model
+    (sparse or dense one-hot input).
+    """
+
+    if self.sparse:
+      return self._predict_sparse(indices, offsets)
+
+    msgs = [indices[start : stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+    text_data = vectorize_sequence(msgs, dim=self.MAX_WORDS, dtype=self.dtype)
+
+    return self._predict(text_data)
+
+
+  def _cached_evaluate(self, indices, offsets):
+    """
+    Evaluate the network only on the messages not stored in the prediction cache.
+    The messages with the same content are evaluated once per call.
+    """
+
+    y_type, y_pred = self._allocate_outputs(offsets.size - 1)
 
-    # pre-process data
-    msgs = [preprocess(line, dictionary) for line in text_list]
+    # group the messages by content
+    groups = OrderedDict()
+    for i, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+      groups.setdefault(PredictionCache.key(indices[start : stop]), []).append(i)
 
-    # Uncomment these lines if you are using a different dictionary
-    # msgs = np.asarray(msgs)
-    msgs = [ [w for w in x if w <= self.MAX_WORDS] for x in msgs ]
+    missing = []
+    for key, rows in groups.items():
+      cached = self._cache.get(key, count=len(rows))
 
-    text_data = vectorize_sequence(msgs, dim=self.MAX_WORDS)
+      if cached is None:
+        missing.append((key, rows))
+      else:
+        y_type[rows], y_pred[rows] = cached
+
+    if missing:
+
+      msgs = [indices[offsets[rows[0]] : offsets[rows[0] + 1]] for _, rows in missing]
+      new_type, new_pred = self._evaluate(*sparse_sequence(msgs, dim=self.MAX_WORDS))
+
+      for (key, rows), t, p in zip(missing, new_type, new_pred):
+        y_type[rows], y_pred[rows] = t, p
+        self._cache.put(key, (t.copy(), p.copy()))
+
+    return y_type, y_pred
+
+
+  def _probabilities(self, text_list, dictionary):
+
+    # pre-process data (the words outside the MAX_WORDS range are discarded)
+    tokens, token_offsets = preprocess_batch(text_list, dictionary, max_words=self.MAX_WORDS)
+
+    indices, offsets = sparse_batch(tokens, token_offsets, dim=self.MAX_WORDS)
 
     # predict the whole list
 
     # dual out - divided to be compatible with last version
     # y_type is topics prediction
     # y_pred is priority prediction as last version - 4 float as probability for each attention level
-    y_type, y_pred = zip(*self._predict(text_data))
 
-    y_pred = np.argmax(np.concatenate(y_pred), axis=1) + 1 # class assignment 1 - less attention
+    if self._cache.maxsize > 0:
+      y_type, y_pred = self._cached_evaluate(indices, offsets)
+    else:
+      y_type, y_pred = self._evaluate(indices, offsets)
+
+    return y_type, y_pred
+
+
+  @property
+  def cache_info(self):
+    """
+    Statistics of the prediction cache (hits, misses, current and max number of entries).
+    """
+    return self._cache.info()
+
+
+  def precision_report(self, text_list, dictionary):
+    """
+    Compare the predictions of the current precision mode with the float64 ones on the given corpus.
+
+    -----------
+
+    Variables
+      text_list: list - the text messages of the corpus
+      dictionary: dict - a dictionary in which keys are words and value are integer (freq order)
+
+    Return
+      report: dict - number of messages, number (and fraction) of priority classes changed with respect to
+                     the float64 model and maximum absolute difference of the probabilities of each output
+    """
+
+    reference = NetworkModel(self._weights_filename, sparse=self.sparse, precision='float64', cache_size=0, mmap=self._mmap)
+
+    ref_type, ref_pred = reference._probabilities(text_list, dictionary)
+    y_type, y_pred = self._probabilities(text_list, dictionary)
+
+    changed = int(np.sum(np.argmax(ref_pred, axis=1) != np.argmax(y_pred, axis=1)))
+    num_messages = len(ref_pred)
+
+    return {'precision' : self.precision,
+            'messages' : num_messages,
+            'changed' : changed,
+            'agreement' : 1. - changed / num_messages if num_messages else 1.,
+            'max_diff_type' : float(np.abs(ref_type - y_type).max()) if num_messages else 0.,
+            'max_diff_pred' : float(np.abs(ref_pred - y_pred).max()) if num_messages else 0.
+            }
+
+
+  def predict_full(self, text_list, bio_params, dictionary):
+    """
+    Evaluate both the outputs of the network with a single pass.
+
+    -----------
+
+    Variables
+      text_list: list - the text messages
+      bio_params: list - the biological parameters associated to each message
+      dictionary: dict - a dictionary in which keys are words and value are integer (freq order)
+
+    Return
+      prediction: misc.Prediction - priority and topic classes with their probabilities
+    """
+
+    y_type, y_pred = self._probabilities(text_list, dictionary)
+    return Prediction(y_type, y_pred)
+
+
+  def predict_iter(self, data, dictionary):
+    """
+    Evaluate both the outputs of the network on a stream of messages in chunks of BATCH_SIZE
+    (see misc.predict_stream).
+
+    -----------
+
+    Variables
+      data: iterable - the (text message, biological parameters) pairs
+      dictionary: dict - a dictionary in which keys are words and value are integer (freq order)
+
+    Return
+      generator - the (priority, topic, priority_proba, topic_proba) of each message in the input order
+    """
+
+    return predict_stream(self.predict_full, data, dictionary, self.BATCH_SIZE)
+
+
+  def predict(self, text_list, bio_params, dictionary):#, binning=True):
+
+    y_pred = self.predict_full(text_list, bio_params, dictionary).priority
 
     # binning the value between [1, 4]
 
@@ -10,9 +10,8 @@ tf.logging.set_verbosity(tf.logging.ERROR)
 
 from keras.models import Model
 from keras.layers import Input, Dense, Activation
-import numpy as np
 
-from misc import preprocess, vectorize_sequence
+from misc import preprocess_batch, vectorize_sequence, Prediction, predict_stream
 
 global DEFAULT_GRAPH
 DEFAULT_GRAPH = tf.get_default_graph()
@@ -74,14 +73,25 @@ class NetworkModel(object):
 
 
 
-  def predict(self, text_list, bio_params, dictionary):#, binning=True):
+  def predict_full(self, text_list, bio_params, dictionary):
+    """
+    Evaluate both the outputs of the network with a single pass.
+
+    -----------
 
-    # pre-process data
-    msgs = [preprocess(line, dictionary) for line in text_list]
+    Variables
+      text_list: list - the text messages
+      bio_params: list - the biological parameters associated to each message
+      dictionary: dict - a dictionary in which keys are words and value are integer (freq order)
+
+    Return
+      prediction: misc.Prediction - priority and topic classes with their probabilities
+    """
 
-    # Uncomment these lines if you are using a different dictionary
-    # msgs = np.asarray(msgs)
-    msgs = [ [w for w in x if w <= self.MAX_WORDS] for x in msgs ]
+    # pre-process data (the words outside the MAX_WORDS range are discarded)
+    tokens, offsets = preprocess_batch(text_list, dictionary, max_words=self.MAX_WORDS)
+
+    msgs = [tokens[start : stop] for start, stop in zip(offsets[:-1], offsets[1:])]
 
     text_data = vectorize_sequence(msgs, dim=self.MAX_WORDS)
 
@@ -93,7 +103,30 @@ class NetworkModel(object):
       # y_pred is priority prediction as last version - 4 float as probability for each attention level
       y_type, y_pred = self.net.predict(text_data, batch_size=self.BATCH_SIZE)
 
-    y_pred = np.argmax(y_pred, axis=1) + 1 # class assignment 1 - less attention
+    return Prediction(y_type, y_pred)
+
+
+  def predict_iter(self, data, dictionary):
+    """
+    Evaluate both the outputs of the network on a stream of messages in chunks of BATCH_SIZE
+    (see misc.predict_stream).
+
+    -----------
+
+    Variables
+      data: iterable - the (text message, biological parameters) pairs
+      dictionary: dict - a dictionary in which keys are words and value are integer (freq order)
+
+    Return
+      generator - the (priority, topic, priority_proba, topic_proba) of each message in the input order
+    """
+
+    return predict_stream(self.predict_full, data, dictionary, self.BATCH_SIZE)
+
+
+  def predict(self, text_list, bio_params, dictionary):#, binning=True):
+
+    y_pred = self.predict_full(text_list, bio_params, dictionary).priority
 
     # binning the value between [1, 4]
 
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import signal
 import time
 
 __author__ = 'Nico Curti'
@@ -110,7 +112,10 @@ if __name__ == '__main__':
 
   try:
 
-    from network_model_tf import NetworkModel
+    from backends import get_backend, backend_from_config
+
+    # the tensorflow model is used if the backend is not set in the config file
+    NetworkModel = get_backend(backend_from_config(db.config, default='tf'))
 
     net = NetworkModel(args.model)
     db.get_logger.info('MODEL LOADED')
@@ -133,6 +138,16 @@ if __name__ == '__main__':
     db.log_error(e)
 
 
+  # the asyncio runtime is used if it is set in the config file ("runtime" : "asyncio")
+  if db.config.get('runtime', 'threads') == 'asyncio':
+
+    from async_runtime import AsyncRuntime
+
+    runtime = AsyncRuntime(db, net, dictionary, args.model, args.update_dir, NetworkModel)
+    runtime.run_forever()
+
+    sys.exit(0)
+
   db.callback_read_last_messages()
   time.sleep(10)
   db.callback_process_messages(net, dictionary)
@@ -143,15 +158,17 @@ if __name__ == '__main__':
   db.callback_clear_log()
   db.callback_score_history_log(args.update_dir)
 
-  db.get_logger.info('FILO BLU Service: STARTING UP')
-
+  # the service is stopped by SIGINT (Ctrl-C) or SIGTERM (ex. Popen.terminate)
+  for signum in (signal.SIGINT, signal.SIGTERM):
+    signal.signal(signum, lambda signum, frame : db.stop())
 
-  while True:
+  db.get_logger.info('FILO BLU Service: STARTING UP')
 
-    if db._wait:
-      net = NetworkModel(args.model)
-      db._wait = False
+  # the main thread sleeps until the network model must be reloaded or the service is stopped
+  while db.wait_reload():
+    net = NetworkModel(args.model)
+    db.set_network(net)
 
-  db.log_error('FILO BLU Service: SHUTDOWN')
+  db.get_logger.info('FILO BLU Service: SHUTDOWN')
 
 
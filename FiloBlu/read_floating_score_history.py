@@ -5,7 +5,10 @@ import os
 import json
 import mysql.connector
 from datetime import datetime
-from collections import defaultdict
+from itertools import tee
+
+from bio_cache import BiologicalCache
+from message_batch import MessageBatchAssembler
 
 __author__ = 'Nico Curti'
 __email__ = 'nico.curti2@unibo.it'
@@ -101,54 +104,24 @@ if __name__ == '__main__':
 
   now = datetime.now()
 
-  cursor.execute('SELECT id_paziente, testo, scritto_il FROM messaggi WHERE scritto_il < "{0}"'.format(now))
-
-  result_query = cursor.fetchall()
-
-  if result_query:
-
-    patient_msg, text_msg, time_msg = zip(*result_query)
-
-    # looking for biological parameters
-    cursor.execute('SELECT parametri_rilevati.id_paziente, parametri_rilevati.valore, parametri.nome \
-                    AS nome_parametro, parametri_rilevati_gruppo.data AS nome_gruppo \
-                    FROM parametri_rilevati JOIN parametri \
-                    ON (parametri_rilevati.id_parametro = parametri.id_parametro) \
-                    JOIN parametri_rilevati_gruppo \
-                    ON (parametri_rilevati.id_parametro_rilevato_gruppo = parametri_rilevati_gruppo.id_parametro_rilevato_gruppo) \
-                    JOIN parametri_gruppi ON (parametri_gruppi.id_gruppo_parametro = parametri_rilevati_gruppo.id_gruppo) \
-                    WHERE parametri_rilevati_gruppo.data <= "{0}"'.format(now))
-
-    # patient_bio, patient_bioval, patient_param, bio_time = zip(*self._cursor.fetchall())
+  # looking for biological parameters (last value of each parameter of the patients with messages)
+  cursor.execute('SELECT DISTINCT id_paziente FROM messaggi WHERE scritto_il < %s', (now, ))
+  patients = [patient for patient, in cursor.fetchall()]
 
-    result_query = defaultdict(dict)
-    for patient_bio, patient_bioval, patient_param, bio_time in cursor.fetchall():
-      result_query[patient_bio][patient_param] = float(patient_bioval)
-      result_query[patient_bio]['storage_time'] = bio_time
+  bio_query = BiologicalCache().get(cursor, patients, now)
 
-    data_to_process = [None] * len(patient_msg)
-
-    for i, patient in enumerate(patient_msg):
-      for bio_patient, bio_params in result_query.items():
-        if patient == bio_patient:
-          data_to_process[i] = (text_msg[i], patient_msg[i], bio_params, time_msg[i])
-          break
-
-      if data_to_process[i] is None:
-        data_to_process[i] = (text_msg[i], patient_msg[i], None, time_msg[i])
-
-    # start to process
-
-    text_msg, patient_id, bio_params, time_msg = zip(*data_to_process)
-
-    score = net.predict(text_msg, bio_params, dictionary, binning=False)
+  # the messages are read from the (unbuffered) cursor and processed in chunks by predict_iter,
+  # so the whole history is never loaded in memory
+  cursor.execute('SELECT id_paziente, testo, scritto_il FROM messaggi WHERE scritto_il < "{0}"'.format(now))
 
-    results_to_write = [(Id, txt, time, s) for s, Id, time, txt in zip(score, patient_id, time_msg, text_msg)]
+  messages, to_process = tee(MessageBatchAssembler.join(cursor, bio_query))
+  data_to_process = ((text_msg, bio_params) for text_msg, _, bio_params, _ in to_process)
 
-    with open(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'floating_score_history.csv')), 'w', encoding='utf-8') as fp:
-      fp.write('patient_id,text_message,time,floating_score\n')
+  scores = net.predict_iter(data_to_process, dictionary)
 
-      for p_id, txt, time, s in results_to_write:
-        txt = txt.replace('\n', '').replace('\r', '')
-        fp.write(','.join([str(p_id), '"' + txt + '"', time.strftime("%m/%d/%Y_%H:%M:%S"), str(s)]) + '\n')
+  with open(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'floating_score_history.csv')), 'w', encoding='utf-8') as fp:
+    fp.write('patient_id,text_message,time,floating_score\n')
 
+    for (txt, p_id, _, time), (s, _, _, _) in zip(messages, scores):
+      txt = txt.replace('\n', '').replace('\r', '')
+      fp.write(','.join([str(p_id), '"' + txt + '"', time.strftime("%m/%d/%Y_%H:%M:%S"), str(s)]) + '\n')
@@ -5,7 +5,8 @@ import os
 import json
 import mysql.connector
 from datetime import datetime
-from collections import defaultdict
+
+from bio_cache import BiologicalCache
 
 __author__ = 'Nico Curti'
 __email__ = 'nico.curti2@unibo.it'
@@ -76,18 +77,11 @@ if __name__ == '__main__':
 
   now = datetime.now()
 
-  cursor.execute('SELECT parametri_rilevati.id_paziente, parametri_rilevati.valore, parametri.nome \
-                                AS nome_parametro, parametri_rilevati_gruppo.data AS nome_gruppo \
-                                FROM parametri_rilevati JOIN parametri \
-                                ON (parametri_rilevati.id_parametro = parametri.id_parametro) \
-                                JOIN parametri_rilevati_gruppo \
-                                ON (parametri_rilevati.id_parametro_rilevato_gruppo = parametri_rilevati_gruppo.id_parametro_rilevato_gruppo) \
-                                JOIN parametri_gruppi ON (parametri_gruppi.id_gruppo_parametro = parametri_rilevati_gruppo.id_gruppo) \
-                                WHERE parametri_rilevati_gruppo.data <= "{0}" '.format(now))
+  cursor.execute('SELECT DISTINCT id_paziente FROM parametri_rilevati')
+  patients = [patient for patient, in cursor.fetchall()]
 
-  result_query = defaultdict(dict)
-  for patient_bio, patient_bioval, patient_param, bio_time in cursor.fetchall():
-    result_query[patient_bio][patient_param] = patient_bioval
+  # last value of each parameter of the patients
+  result_query = BiologicalCache().get(cursor, patients, now)
 
-  print(json.dumps(result_query, indent = 4))
+  print(json.dumps(result_query, indent = 4, default=str))
 
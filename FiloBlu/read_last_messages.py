@@ -5,7 +5,9 @@ import os
 import json
 import mysql.connector
 from datetime import datetime
-from collections import defaultdict
+
+from bio_cache import BiologicalCache
+from message_batch import MessageBatchAssembler
 
 __author__ = 'Nico Curti'
 __email__ = 'nico.curti2@unibo.it'
@@ -73,40 +75,13 @@ if __name__ == '__main__':
 
   cursor.execute('SELECT id_paziente, testo, scritto_il FROM messaggi WHERE scritto_il < "{0}" AND sa_score = 0'.format(now))
 
-  result_query = cursor.fetchall()
-
-  if result_query:
-
-    patient_msg, text_msg, time_msg = zip(*result_query)
-
-    # looking for biological parameters
-    # looking for biological parameters
-    cursor.execute('SELECT parametri_rilevati.id_paziente, parametri_rilevati.valore, parametri.nome \
-                    AS nome_parametro, parametri_rilevati_gruppo.data AS nome_gruppo \
-                    FROM parametri_rilevati JOIN parametri \
-                    ON (parametri_rilevati.id_parametro = parametri.id_parametro) \
-                    JOIN parametri_rilevati_gruppo \
-                    ON (parametri_rilevati.id_parametro_rilevato_gruppo = parametri_rilevati_gruppo.id_parametro_rilevato_gruppo) \
-                    JOIN parametri_gruppi ON (parametri_gruppi.id_gruppo_parametro = parametri_rilevati_gruppo.id_gruppo) \
-                    WHERE parametri_rilevati_gruppo.data <= "{0}"'.format(now))
-
-    # patient_bio, patient_bioval, patient_param, bio_time = zip(*self._cursor.fetchall())
-
-    result_query = defaultdict(dict)
-    for patient_bio, patient_bioval, patient_param, bio_time in cursor.fetchall():
-      result_query[patient_bio][patient_param] = float(patient_bioval)
-      result_query[patient_bio]['storage_time'] = bio_time
-
-    data_to_process = [None] * len(patient_msg)
+  # looking for biological parameters (last value of each parameter of the patients)
+  bio_cache = BiologicalCache()
+  assembler = MessageBatchAssembler(lambda patients : bio_cache.get(cursor, patients, now))
 
-    for i, patient in enumerate(patient_msg):
-      for bio_patient, bio_params in result_query.items():
-        if patient == bio_patient:
-          data_to_process[i] = (text_msg[i], patient_msg[i], bio_params, time_msg[i])
-          break
+  batch = assembler.assemble(cursor)
 
-      if data_to_process[i] is None:
-        data_to_process[i] = (text_msg[i], patient_msg[i], None, time_msg[i])
+  if batch:
 
-    print(data_to_process)
+    print(list(zip(batch.text, batch.patient.tolist(), batch.bio_params, batch.time.tolist())))
 
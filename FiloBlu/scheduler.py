@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import random
+import threading
+from functools import wraps
+from itertools import count
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+FIXED_RATE = 'rate' # the runs start at fixed times (start + k * interval), the late runs do not accumulate drift
+FIXED_DELAY = 'delay' # each run starts interval seconds after the end of the previous one
+
+
+class Job(object):
+  """
+  Periodic job of the Scheduler.
+  Each job is executed by its own worker thread, so a slow job never delays the other ones and a job
+  never overlaps with itself: if a fixed-rate run is due while the previous one is still running the
+  run is skipped.
+
+  --------
+
+  Members
+    - name : string - the job name (unique in the scheduler)
+    - function : callable - the function called at each run
+    - interval : float - the time in seconds between two runs (see mode)
+    - mode : string - FIXED_RATE or FIXED_DELAY
+    - jitter : float - max random delay in seconds added to each run
+    - args : tuple - the positional arguments of the function (they can be changed between two runs)
+    - kwargs : dict - the keyword arguments of the function
+  """
+
+  def __init__(self, name, function, interval, mode, jitter, args, kwargs):
+
+    if mode not in (FIXED_RATE, FIXED_DELAY):
+      raise ValueError('Unknown job mode. Given {}, possible values are ({}, {})'.format(mode, FIXED_RATE, FIXED_DELAY))
+
+    if interval < 0 or jitter < 0:
+      raise ValueError('The interval and the jitter must be positive. Given {} and {}'.format(interval, jitter))
+
+    if mode == FIXED_RATE and interval == 0:
+      raise ValueError('A fixed-rate job requires a positive interval')
+
+    self.name = name
+    self.function = function
+    self.interval = interval
+    self.mode = mode
+    self.jitter = jitter
+    self.args = args
+    self.kwargs = kwargs
+
+    self._base = None # scheduled time of the next run (without jitter)
+    self._due = None # scheduled time of the next run (with jitter)
+    self._fired_due = None # scheduled time of the triggered run (the lateness is measured from it)
+    self._skipped_due = None # scheduled time of the first run skipped since the last start
+    self._running = False
+    self._paused = False
+    self._queued = False # True if the job is in the queue of the scheduler
+    self._trigger = threading.Event()
+    self._thread = None
+
+    self._stats = {'runs' : 0, 'errors' : 0, 'skipped' : 0, 'missed' : 0, 'paused' : 0,
+                   'run_time' : 0., 'max_run_time' : 0., 'last_run_time' : 0.,
+                   'lateness' : 0., 'max_lateness' : 0., 'last_lateness' : 0.}
+
+  def _set_next(self, base):
+    self._base = base
+    self._due = base + (random.uniform(0, self.jitter) if self.jitter else 0.)
+
+
+class Scheduler(object):
+  """
+  Single scheduler of the periodic jobs of the service.
+  A dispatcher thread waits for the next due job and it wakes up its worker thread.
+
+  - fixed-rate jobs run at start + k * interval (the lateness of a run does not move the next ones);
+    the runs missed while the job was running (or the process was suspended) are skipped and counted.
+  - fixed-delay jobs run interval seconds after the end of the previous run (interval = 0 means that
+    the job is called again as soon as it returns, so it must block waiting for new work).
+  - the paused jobs are not started until they are resumed (the running run is completed).
+  - the jitter adds a random delay in [0, jitter] seconds to each run, so the jobs with the same
+    interval do not hit the db at the same time.
+
+  For each job the number of runs, errors, skipped (still running), missed and paused runs and the
+  run time and lateness (start time - scheduled time) statistics are collected (see stats).
+  After an overrun the lateness of the next run is measured from the first skipped run.
+
+  --------
+
+  Members
+    - on_error : callable - function called with the exception raised by a job (the job is not stopped)
+
+  --------
+
+  Example
+    scheduler = Scheduler()
+    scheduler.add_job('read', read_messages, interval=40)
+    scheduler.add_job('process', process_messages, interval=0, mode=FIXED_DELAY, delay=0)
+    ...
+    scheduler.stop()
+  """
+
+  def __init__(self, on_error=None):
+    """
+    Scheduler constructor.
+
+    --------
+
+    Variables
+      - on_error : callable - function called with the exception raised by a job
+    """
+    self.on_error = on_error
+
+    self._jobs = {}
+    self._queue = [] # heap of (due time, counter, job)
+    self._counter = count()
+    self._cond = threading.Condition()
+    self._stopped = False
+
+    self._dispatcher = threading.Thread(target=self._dispatch, name='scheduler')
+    self._dispatcher.daemon = True # stop if the program exits
+    self._dispatcher.start()
+
+  def add_job(self, name, function, interval, mode=FIXED_RATE, delay=None, jitter=0., args=(), kwargs=None):
+    """
+    Register a new job.
+
+    --------
+
+    Variables
+      - name : string - the job name (unique)
+      - function : callable - the function called at each run
+      - interval : float - the time in seconds between two runs
+      - mode : string - FIXED_RATE (default) or FIXED_DELAY
+      - delay : float - the time in seconds before the first run (interval by default)
+      - jitter : float - max random delay in seconds added to each run
+      - args : tuple - the positional arguments of the function
+      - kwargs : dict - the keyword arguments of the function
+
+    Return
+      - Job - the registered job
+    """
+
+    job = Job(name, function, interval, mode, jitter, tuple(args), dict(kwargs or {}))
+
+    with self._cond:
+
+      if self._stopped:
+        raise RuntimeError('The scheduler is stopped')
+
+      if name in self._jobs:
+        raise ValueError('Job {} already registered'.format(name))
+
+      self._jobs[name] = job
+
+      job._thread = threading.Thread(target=self._work, args=(job,), name='scheduler-{}'.format(name))
+      job._thread.daemon = True # stop if the program exits
+      job._thread.start()
+
+      job._set_next(time.monotonic() + (interval if delay is None else delay))
+      self._push(job)
+
+    return job
+
+  def _push(self, job):
+    # the caller holds the lock
+    heapq.heappush(self._queue, (job._due, next(self._counter), job))
+    job._queued = True
+    self._cond.notify_all()
+
+  def _dispatch(self):
+    # dispatcher thread: it starts the due jobs and it schedules the next fixed-rate runs
+
+    with self._cond:
+
+      while not self._stopped:
+
+        now = time.monotonic()
+
+        while self._queue and self._queue[0][0] <= now:
+
+          _, _, job = heapq.heappop(self._queue)
+          job._queued = False
+
+          if job._paused:
+            # the paused fixed-delay jobs are queued again by resume
+            job._stats['paused'] += 1
+
+          elif job._running:
+            job._stats['skipped'] += 1
+
+            if job._skipped_due is None:
+              job._skipped_due = job._due
+
+          else:
+            # the lateness is measured from the first run skipped by an overrun (if any), and the due time
+            # is stored here because _set_next overwrites it before the worker starts
+            job._fired_due = job._due if job._skipped_due is None else job._skipped_due
+            job._skipped_due = None
+            job._running = True
+            job._trigger.set()
+
+          if job.mode == FIXED_RATE:
+            # the missed runs are skipped, the next run is kept aligned to the original schedule
+            runs = int((now - job._base) // job.interval) + 1
+            job._stats['missed'] += runs - 1
+            job._set_next(job._base + runs * job.interval)
+            self._push(job)
+
+          # the fixed-delay jobs are queued again by their worker at the end of the run
+
+        timeout = self._queue[0][0] - now if self._queue else None
+        self._cond.wait(timeout)
+
+  def _work(self, job):
+    # worker thread of a job: it runs the job each time it is triggered by the dispatcher
+
+    while True:
+
+      job._trigger.wait()
+      job._trigger.clear()
+
+      if self._stopped:
+        with self._cond:
+          job._running = False
+          self._cond.notify_all()
+        break
+
+      start = time.monotonic()
+      lateness = max(start - job._fired_due, 0.)
+
+      try:
+        job.function(*job.args, **job.kwargs)
+
+      except Exception as e:
+
+        with self._cond:
+          job._stats['errors'] += 1
+
+        if self.on_error is not None:
+          self.on_error(e)
+
+      end = time.monotonic()
+
+      with self._cond:
+
+        job._running = False
+        stats = job._stats
+        stats['runs'] += 1
+        stats['last_run_time'] = end - start
+        stats['run_time'] += end - start
+        stats['max_run_time'] = max(stats['max_run_time'], end - start)
+        stats['last_lateness'] = lateness
+        stats['lateness'] += lateness
+        stats['max_lateness'] = max(stats['max_lateness'], lateness)
+
+        if job.mode == FIXED_DELAY and not self._stopped:
+          job._set_next(end + job.interval)
+          self._push(job)
+
+        self._cond.notify_all()
+
+  def __getitem__(self, name):
+    return self._jobs[name]
+
+  def __contains__(self, name):
+    return name in self._jobs
+
+  def pause(self, *names):
+    """
+    Pause the given jobs (all the jobs if no name is given).
+    The running runs are completed, the next ones are not started until the jobs are resumed.
+    """
+    with self._cond:
+      for name in names or list(self._jobs):
+        self._jobs[name]._paused = True
+
+  def resume(self, *names):
+    """
+    Resume the given paused jobs (all the jobs if no name is given).
+    The fixed-delay jobs run immediately, the fixed-rate jobs at their next scheduled time.
+    """
+    with self._cond:
+
+      now = time.monotonic()
+
+      for name in names or list(self._jobs):
+
+        job = self._jobs[name]
+        job._paused = False
+
+        if job._queued or job._running:
+          continue
+
+        if job.mode == FIXED_RATE:
+          runs = max(int((now - job._base) // job.interval) + 1, 0)
+          job._set_next(job._base + runs * job.interval)
+        else:
+          job._set_next(now)
+
+        self._push(job)
+
+  def is_paused(self, name):
+    """
+    Check if the given job is paused.
+    """
+    return self._jobs[name]._paused
+
+  def wait_idle(self, *names, timeout=None):
+    """
+    Wait until the given jobs (all the jobs if no name is given) are not running.
+
+    --------
+
+    Variables
+      - timeout : float - max waiting time in seconds
+
+    Return
+      - bool - False if the timeout expired
+    """
+    with self._cond:
+      jobs = [self._jobs[name] for name in names or list(self._jobs)]
+      return self._cond.wait_for(lambda : not any(job._running for job in jobs), timeout)
+
+  def stop(self, timeout=None):
+    """
+    Stop the scheduler: no new run is started and the running ones are waited (up to timeout seconds).
+    """
+    with self._cond:
+      self._stopped = True
+      self._queue = []
+      self._cond.notify_all()
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    for job in list(self._jobs.values()):
+      job._trigger.set()
+      job._thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+    self._dispatcher.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+  def stats(self):
+    """
+    Get the statistics of the jobs.
+
+    --------
+
+    Return
+      - dict - for each job name its mode, interval and state (idle, running or paused), the number of runs,
+               errors, skipped (still running), missed and paused runs, the last, mean and max run time (seconds)
+               and the last, mean and max lateness (seconds)
+    """
+    with self._cond:
+
+      stats = {}
+
+      for name, job in self._jobs.items():
+
+        job_stats = dict(job._stats)
+        runs = max(job_stats['runs'], 1)
+        job_stats['run_time'] /= runs
+        job_stats['lateness'] /= runs
+        job_stats.update({'mode' : job.mode, 'interval' : job.interval,
+                          'state' : 'paused' if job._paused else 'running' if job._running else 'idle'})
+        stats[name] = job_stats
+
+      return stats
+
+
+def scheduled(interval, mode=FIXED_RATE, delay=None, jitter=0.):
+  """
+  This function create a decorator of the methods of an object with a 'scheduler' member (Scheduler).
+  The call of the decorated method registers it as a scheduler job (named as the method) with the given
+  arguments and it returns the Job.
+
+  ---------
+
+  Variable
+    - interval : (float) - time in seconds between two runs (see Scheduler.add_job)
+    - mode : (string) - FIXED_RATE or FIXED_DELAY
+    - delay : (float) - time in seconds before the first run (interval by default)
+    - jitter : (float) - max random delay in seconds added to each run
+  """
+
+  def decorator(function):
+
+    @wraps(function)
+    def wrapper(self, *args, **kwargs):
+      return self.scheduler.add_job(function.__name__, function.__get__(self, type(self)), interval,
+                                    mode=mode, delay=delay, jitter=jitter, args=args, kwargs=kwargs)
+
+    return wrapper
+
+  return decorator
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+import os
+import json
+import pickle
+import struct
+import numpy as np
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# The weights file is given by
+#
+#   MAGIC (8 bytes) | version (uint32) | header size (uint32) | json header | padding | arrays
+#
+# The json header stores the name, the dtype, the shape and the offset of each array measured from the
+# beginning of the data section, i.e. the first multiple of ALIGNMENT bytes after the header.
+# Each array starts at a multiple of ALIGNMENT bytes so it can be memory-mapped without copies.
+#
+# A memory-mapped file must never be rewritten in place: the truncation of the file by open(filename, 'wb')
+# changes the arrays of the running model (or raises SIGBUS). The file is always updated by a write aside and
+# an os.replace (save_weights and the hot reload of the services), which on POSIX systems gives a new inode to
+# the path, so the arrays mapped from the old file stay valid until they are released. On Windows the replace
+# of a mapped file fails (PermissionError), so there the arrays are copied in memory (see MMAP).
+
+MAGIC = b'FILOBLUW'
+VERSION = 1
+ALIGNMENT = 64
+
+# layer names of the NNet architecture in the order of the pickle list (weights, bias) of each layer
+LAYERS = ('dense_1', 'dense_2', 'out_type', 'out_P')
+PARAMS = ('kernel', 'bias')
+
+_PREAMBLE = struct.Struct('<8sII')
+
+MMAP = os.name != 'nt' # default of load_weights: memory-mapped arrays except on Windows (see above)
+
+
+def _align(size):
+  return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def is_weights_file(filename):
+  """
+  Check if the given file is stored in the memory-mapped weights format.
+
+  ---------
+
+  Variables
+    - filename : string - the weights filename
+
+  Return
+    - bool - True if the file starts with the format magic number
+  """
+  with open(filename, 'rb') as fp:
+    return fp.read(len(MAGIC)) == MAGIC
+
+
+def save_weights(model, filename, dtype=None, layers=LAYERS):
+  """
+  Write the list of weights in the memory-mapped weights format.
+  The file is written aside and moved on the given filename, so the arrays memory-mapped from the previous
+  version of the file are not changed.
+
+  ---------
+
+  Variables
+    - model : list - the list of arrays (kernel, bias) of each layer in the layers order (as the pickle file)
+    - filename : string - the output filename
+    - dtype : type - optional data type of the stored arrays (the original one is used if None)
+    - layers : list - the names of the layers
+  """
+
+  if len(model) != len(layers) * len(PARAMS):
+    raise ValueError('The model given not correspond to the NNet architecture')
+
+  arrays = [np.ascontiguousarray(w, dtype=dtype) for w in model]
+  names = [(layer, param) for layer in layers for param in PARAMS]
+
+  entries = []
+  offset = 0
+  for (layer, param), arr in zip(names, arrays):
+    entries.append({'layer' : layer,
+                    'param' : param,
+                    'dtype' : arr.dtype.str,
+                    'shape' : list(arr.shape),
+                    'offset' : offset
+                    })
+    offset = _align(offset + arr.nbytes)
+
+  header = json.dumps({'version' : VERSION, 'alignment' : ALIGNMENT, 'arrays' : entries}).encode('utf-8')
+  data_start = _align(_PREAMBLE.size + len(header))
+
+  tmp_filename = filename + '.tmp'
+
+  with open(tmp_filename, 'wb') as fp:
+    fp.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)))
+    fp.write(header)
+
+    for entry, arr in zip(entries, arrays):
+      fp.write(b'\0' * (data_start + entry['offset'] - fp.tell()))
+      fp.write(arr.tobytes())
+
+  os.replace(tmp_filename, filename)
+
+
+def read_header(filename):
+  """
+  Read the json header of a weights file.
+
+  ---------
+
+  Variables
+    - filename : string - the weights filename
+
+  Return
+    - header : dict - the header with the description of the stored arrays and the start of the data section
+  """
+
+  with open(filename, 'rb') as fp:
+    magic, version, header_size = _PREAMBLE.unpack(fp.read(_PREAMBLE.size))
+
+    if magic != MAGIC:
+      raise ValueError('The file {} is not a FiloBlu weights file'.format(filename))
+
+    if version > VERSION:
+      raise ValueError('Unsupported weights file version {} (max supported {})'.format(version, VERSION))
+
+    header = json.loads(fp.read(header_size).decode('utf-8'))
+
+  header['data_start'] = _align(_PREAMBLE.size + header_size)
+  return header
+
+
+def load_weights(filename, layers=LAYERS, mmap=MMAP):
+  """
+  Load the weights file as a list of read-only arrays.
+  With mmap=True (the default except on Windows) the arrays are memory-mapped: the data are not copied and
+  they share the OS page-cache pages of the file, so different processes which load the same file share the
+  same physical memory. The file can be replaced by os.replace while the arrays are in use, but it must not
+  be rewritten in place.
+  With mmap=False the data section is read by a single np.fromfile and the arrays are views of this buffer,
+  so the file is closed at the end of the function.
+
+  ---------
+
+  Variables
+    - filename : string - the weights filename
+    - layers : list - the names of the layers to load
+    - mmap : bool - if True the arrays are memory-mapped instead of copied in memory
+
+  Return
+    - model : list - the list of arrays (kernel, bias) of each layer in the layers order (as the pickle file)
+  """
+
+  header = read_header(filename)
+
+  if mmap:
+    arrays = {(entry['layer'], entry['param']) : np.memmap(filename, mode='r',
+                                                           dtype=np.dtype(entry['dtype']),
+                                                           offset=header['data_start'] + entry['offset'],
+                                                           shape=tuple(entry['shape']))
+              for entry in header['arrays']}
+
+  else:
+    # the offsets are multiple of ALIGNMENT bytes, so the views are aligned as the memory-mapped arrays
+    data = np.fromfile(filename, dtype='u1', offset=header['data_start'])
+    data.flags.writeable = False
+
+    arrays = {}
+    for entry in header['arrays']:
+      dtype = np.dtype(entry['dtype'])
+      shape = tuple(entry['shape'])
+      nbytes = dtype.itemsize * int(np.prod(shape))
+      arrays[(entry['layer'], entry['param'])] = data[entry['offset'] : entry['offset'] + nbytes].view(dtype).reshape(shape)
+
+  try:
+    return [arrays[(layer, param)] for layer in layers for param in PARAMS]
+
+  except KeyError as e:
+    raise ValueError('The weights file {} does not contain the layer {}'.format(filename, e.args[0][0]))
+
+
+def convert_pickle(pickle_filename, filename, dtype=None):
+  """
+  Convert the pickle weights file in the memory-mapped weights format.
+
+  ---------
+
+  Variables
+    - pickle_filename : string - the pickle weights filename
+    - filename : string - the output filename
+    - dtype : type - optional data type of the stored arrays (the original one is used if None)
+  """
+
+  with open(pickle_filename, 'rb') as fp:
+    model = pickle.load(fp)
+
+  save_weights(model, filename, dtype=dtype)
+
+
+def parse_args():
+  """
+  Just a simple parser of the command line.
+
+  -----
+
+  Return
+
+    args : object - Each member of the object identify a different command line argument (properly casted)
+  """
+
+  import argparse
+
+  description = 'Filo Blu weights converter (pickle -> memory-mapped format)'
+
+  parser = argparse.ArgumentParser(description = description)
+  parser.add_argument('--input',
+                      dest='input',
+                      type=str,
+                      required=True,
+                      action='store',
+                      help='Pickle weights filename'
+                      )
+  parser.add_argument('--output',
+                      dest='output',
+                      type=str,
+                      required=False,
+                      action='store',
+                      help='Output weights filename (default: input filename with .fbw extension)',
+                      default=None
+                      )
+  parser.add_argument('--dtype',
+                      dest='dtype',
+                      type=str,
+                      required=False,
+                      action='store',
+                      help='Data type of the stored arrays (ex. float32)',
+                      default=None
+                      )
+
+  args = parser.parse_args()
+  args.input = os.path.abspath(args.input)
+  args.output = os.path.abspath(args.output) if args.output else os.path.splitext(args.input)[0] + '.fbw'
+
+  return args
+
+
+if __name__ == '__main__':
+
+  args = parse_args()
+
+  convert_pickle(args.input, args.output, dtype=args.dtype)
+
+  print('Weights converted: {} -> {}'.format(args.input, args.output))
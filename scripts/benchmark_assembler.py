@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'FiloBlu'))
+
+from message_batch import MessageBatchAssembler
+
+__author__  = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# (number of messages, number of patients) of each benchmark
+SIZES = [(1000, 100), (10000, 1000), (100000, 1000), (100000, 10000)]
+# the old nested loop is evaluated only up to this number of (message, patient) pairs
+MAX_NESTED_LOOP = 10**8
+
+def nested_loop_join(rows, bio_params):
+  """
+  The old join: each message is compared with all the patients with biological parameters.
+  """
+  patient_msg, text_msg, time_msg = zip(*rows)
+  data_to_process = [None] * len(patient_msg)
+
+  for i, patient in enumerate(patient_msg):
+    for bio_patient, params in bio_params.items():
+      if patient == bio_patient:
+        data_to_process[i] = (text_msg[i], patient_msg[i], params, time_msg[i])
+        break
+
+    if data_to_process[i] is None:
+      data_to_process[i] = (text_msg[i], patient_msg[i], None, time_msg[i])
+
+  return data_to_process
+
+
+def make_data(num_messages, num_patients, seed=42):
+  """
+  Random messages and biological parameters (half of the patients have parameters).
+  """
+  rng = random.Random(seed)
+  now = datetime.now()
+
+  rows = [(rng.randrange(num_patients), 'messaggio {}'.format(i), now - timedelta(seconds=i)) for i in range(num_messages)]
+  bio_params = {patient : {'FC' : 70., 'PAS' : 120., 'storage_time' : now} for patient in range(0, num_patients, 2)}
+
+  return rows, bio_params
+
+
+def timeit(func, *args, repeat=3):
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = func(*args)
+    best = min(best, time.perf_counter() - start)
+  return best, result
+
+
+if __name__ == '__main__':
+
+  assembler_join = lambda rows, bio_params : list(MessageBatchAssembler.join(rows, bio_params))
+
+  print('{:>10} {:>10} {:>14} {:>14} {:>10}'.format('messages', 'patients', 'nested (s)', 'hash join (s)', 'speedup'))
+
+  for num_messages, num_patients in SIZES:
+
+    rows, bio_params = make_data(num_messages, num_patients)
+
+    hash_time, result = timeit(assembler_join, rows, bio_params)
+
+    if num_messages * len(bio_params) <= MAX_NESTED_LOOP:
+      nested_time, reference = timeit(nested_loop_join, rows, bio_params, repeat=1)
+      assert result == reference
+
+      print('{:>10d} {:>10d} {:>14.4f} {:>14.4f} {:>9.1f}x'.format(num_messages, num_patients, nested_time, hash_time, nested_time / hash_time))
+
+    else:
+      print('{:>10d} {:>10d} {:>14} {:>14.4f} {:>10}'.format(num_messages, num_patients, '-', hash_time, '-'))